@@ -5,7 +5,7 @@ from os import environ as env
 
 from authlib.integrations.flask_client import OAuth
 from dotenv import find_dotenv, load_dotenv
-from flask import (Flask, abort, jsonify, redirect, render_template, request,
+from flask import (Flask, current_app, jsonify, redirect, render_template,
                    session, url_for)
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
@@ -13,9 +13,15 @@ from six.moves.urllib.parse import urlencode
 from werkzeug.exceptions import HTTPException
 
 import constants
-from auth import (AuthError, get_token_auth_header, requires_auth,
+from auth import (AuthError, get_token_auth_header, jwks_store, token_cache,
                   verify_decode_jwt)
-from models import Dessert, Drink, setup_db
+from cache import listing_cache
+from compression import init_compression
+from metrics import Collector, init_metrics
+from models import pool_stats, setup_db
+from profiling import init_profiling
+from ratelimit import init_rate_limiting, retry_after_headers
+from resources import register_menu_resources
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
@@ -29,12 +35,76 @@ AUTH0_BASE_URL = 'https://' + AUTH0_DOMAIN
 AUTH0_AUDIENCE = env.get(constants.AUTH0_AUDIENCE)
 
 
+def cache_stats():
+    compressor = current_app.extensions.get('compressor')
+    for name, stats in (('listing', listing_cache.backend.stats()),
+                        ('token', token_cache.stats()),
+                        ('compressed',
+                         compressor.cache.stats() if compressor else {})):
+        for result, key in (('hit', 'hits'), ('miss', 'misses')):
+            if key in stats:
+                yield (name, result), stats[key]
+
+
+def requests_shed():
+    limiter = current_app.extensions.get('rate_limiter')
+    admission = current_app.extensions.get('admission')
+    subscribers = current_app.extensions.get('event_subscribers')
+    yield ('rate_limit',), limiter.limited if limiter else 0
+    yield ('concurrency',), admission.rejected if admission else 0
+    yield ('event_subscribers',), subscribers.rejected if subscribers else 0
+
+
+def requests_in_flight():
+    admission = current_app.extensions.get('admission')
+    yield (), admission.in_flight if admission else 0
+
+
+def replica_health():
+    replicas = current_app.extensions.get('replicas')
+    for index, engine in enumerate(replicas.engines if replicas else ()):
+        yield (str(index),), int(replicas.is_up(engine))
+
+
+METRIC_COLLECTORS = [
+    Collector('db_pool_events_total',
+              'Connection pool events since the process started.',
+              'counter',
+              lambda: [((name,), value)
+                       for name, value in pool_stats.snapshot().items()
+                       if 'checked_out' not in name],
+              labels=('event',)),
+    Collector('db_pool_checked_out',
+              'Connections currently checked out of the pool.', 'gauge',
+              lambda: [((), pool_stats.checked_out)]),
+    Collector('db_pool_peak_checked_out',
+              'Most connections checked out at once.', 'gauge',
+              lambda: [((), pool_stats.peak_checked_out)]),
+    Collector('cache_lookups_total', 'Cache lookups by result.', 'counter',
+              cache_stats, labels=('cache', 'result')),
+    Collector('requests_shed_total',
+              'Requests refused by the rate limiter or concurrency cap.',
+              'counter', requests_shed, labels=('reason',)),
+    Collector('requests_in_flight', 'Requests being handled right now.',
+              'gauge', requests_in_flight),
+    Collector('db_replica_up',
+              'Whether each read replica is in rotation (1) or skipped (0).',
+              'gauge', replica_health, labels=('replica',)),
+    Collector('jwks_fetches_total', 'JWKS documents downloaded.', 'counter',
+              lambda: [((), jwks_store.fetch_count)]),
+]
+
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
     app.secret_key = constants.SECRET_KEY
     CORS(app)
     setup_db(app)
+    init_metrics(app, METRIC_COLLECTORS)
+    init_profiling(app)
+    init_compression(app)
+    init_rate_limiting(app)
 
     @app.errorhandler(Exception)
     def handle_auth_error(ex):
@@ -108,135 +178,7 @@ def create_app(test_config=None):
                                userinfo_pretty=json.dumps(session[constants.
                                JWT_PAYLOAD], indent=4), token=session['token'])
 
-    @app.route('/drinks')
-    @requires_auth('get:drinks')
-    def view_drinks(jwt):
-        try:
-            drinks = Drink.query.all()
-            if drinks is None:
-                abort(404)
-        except Exception as e:
-            print(e)
-        return jsonify({
-            'success': True,
-            'drinks': [drink.format() for drink in drinks]
-        })
-
-    @app.route('/desserts')
-    @requires_auth('get:desserts')
-    def view_dessert(jwt):
-        try:
-            desserts = Dessert.query.all()
-            if desserts is None:
-                abort(404)
-        except Exception as e:
-            print(e)
-        return jsonify({
-            'success': True,
-            'desserts': [dessert.format() for dessert in desserts]
-        })
-
-    @app.route('/drinks', methods=['POST'])
-    @requires_auth('post:drinks')
-    def create_drink(jwt):
-        body = request.get_json()
-        if body is None:
-            abort(400)
-        drink_title = body.get('title')
-        drink = Drink(title=drink_title)
-        drink.insert()
-        return jsonify({
-            'success': True,
-            'drinks': [drink.format()]
-        })
-
-    @app.route('/desserts', methods=['POST'])
-    @requires_auth('post:desserts')
-    def create_dessert(jwt):
-        body = request.get_json()
-        if body is None:
-            abort(400)
-        dessert_title = body.get('title')
-        dessert = Dessert(title=dessert_title)
-        dessert.insert()
-        return jsonify({
-            'success': True,
-            'desserts': [dessert.format()]
-        })
-
-    @app.route('/drinks/<id>', methods=['PATCH'])
-    @requires_auth('patch:drinks')
-    def update_drink(jwt, id):
-        drink = Drink.query.get(id)
-        if drink:
-            try:
-                body = request.get_json()
-                new_title = body.get('title')
-                if new_title:
-                    drink.title = new_title
-                drink.update()
-                return jsonify({
-                    'success': True,
-                    'drinks': [drink.format()]
-                })
-            except Exception as e:
-                print(e)
-                abort(422)
-        else:
-            abort(404)
-
-    @app.route('/desserts/<id>', methods=['PATCH'])
-    @requires_auth('patch:desserts')
-    def update_dessert(jwt, id):
-        dessert = Dessert.query.get(id)
-        if dessert:
-            try:
-                body = request.get_json()
-                new_title = body.get('title')
-                if new_title:
-                    dessert.title = new_title
-                dessert.update()
-                return jsonify({
-                    'success': True,
-                    'desserts': [dessert.format()]
-                })
-            except Exception as e:
-                print(e)
-                abort(422)
-        else:
-            abort(404)
-
-    @app.route('/drinks/<id>', methods=['DELETE'])
-    @requires_auth('delete:drinks')
-    def delete_drink(jwt, id):
-        drink = Drink.query.get(id)
-        if drink:
-            try:
-                drink.delete()
-                return jsonify({
-                    'success': True,
-                    'delete': id
-                })
-            except:
-                abort(422)
-        else:
-            abort(404)
-
-    @app.route('/desserts/<id>', methods=['DELETE'])
-    @requires_auth('delete:desserts')
-    def delete_dessert(jwt, id):
-        dessert = Dessert.query.get(id)
-        if dessert:
-            try:
-                dessert.delete()
-                return jsonify({
-                    'success': True,
-                    'delete': id
-                })
-            except:
-                abort(422)
-        else:
-            abort(404)
+    register_menu_resources(app)
 
     @app.errorhandler(AuthError)
     def auth_error(error):
@@ -270,6 +212,22 @@ def create_app(test_config=None):
             "message": "bad_request"
         }), 400
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too_many_requests"
+        }), 429, retry_after_headers(error)
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service_unavailable"
+        }), 503, retry_after_headers(error)
+
     return app
 
 
@@ -0,0 +1,638 @@
+import logging
+import sqlite3
+from datetime import datetime
+from functools import wraps
+from os import environ as env
+
+from databases import Database
+from sqlalchemy import case, select
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, is_resource_modified
+
+from auth import AuthError, requires_auth_async
+from cache import listing_cache
+from events import (EVENT_HEARTBEAT, HEARTBEAT, RESET, RETRY, AsyncSubscriber,
+                    broker, format_event, publish_change)
+from idempotency import (IDEMPOTENCY_HEADER, REPLAYED_HEADER, claim, release,
+                         store_response)
+from models import (BULK_INSERT_ATTEMPTS, POOL_SETTINGS, TableVersion,
+                    Tombstone, database_path, tombstone_rows, upsert_lookup,
+                    upsert_stamp, upsert_statement, version_bump,
+                    version_query)
+from ratelimit import (ADMISSION_EXEMPT_PATHS, admission_from_env,
+                       rate_limiter_from_env, retry_after_headers)
+from resources import (MENU_RESOURCES, NDJSON_MIMETYPE, STREAM_CHUNK_ROWS,
+                       bulk_results, changes_body, listing_etag, page_body,
+                       parse_bulk_ids, parse_bulk_renames, parse_bulk_titles,
+                       parse_page_args, parse_search_args, parse_since,
+                       parse_upsert_title, prefers_ndjson, readable_tables,
+                       settled_last_modified, upsert_body, version_tag,
+                       wants_upsert)
+from search import current_index, store_index, title_matches, title_ranking
+from serializers import dumps, dumps_compact
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+# The async drivers raise their own errors rather than SQLAlchemy's.
+INTEGRITY_ERRORS = (sqlite3.IntegrityError,) + (
+    (asyncpg.exceptions.IntegrityConstraintViolationError,) if asyncpg
+    else ())
+
+'''
+ASGI entry point
+The menu API served by async handlers, for deployments that hold many
+idle keep-alive connections. Run it with
+`gunicorn asgi:app -k uvicorn.workers.UvicornWorker`. Queries go through
+an async driver pool (asyncpg on Postgres, aiosqlite on SQLite) and JWKS
+keys are fetched without blocking the event loop. Responses, caching and
+permissions match the WSGI app in app.py.
+'''
+
+
+def async_database_url(url):
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def pool_options(url):
+    if not url.startswith(('postgres://', 'postgresql://')):
+        return {}
+    size = int(env.get(POOL_SETTINGS['pool_size'][0],
+                       POOL_SETTINGS['pool_size'][2]))
+    overflow = int(env.get(POOL_SETTINGS['max_overflow'][0],
+                           POOL_SETTINGS['max_overflow'][2]))
+    return {'min_size': 1, 'max_size': size + overflow}
+
+
+database = Database(async_database_url(database_path),
+                    **pool_options(database_path))
+logger = logging.getLogger(__name__)
+
+
+class SortedJSONResponse(JSONResponse):
+    # Same bytes as Flask's jsonify: sorted keys, compact, trailing newline.
+    def render(self, content):
+        return dumps(content)
+
+
+def abort(status_code):
+    raise StarletteHTTPException(status_code)
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def idempotent(handler):
+    # The async counterpart of idempotency.idempotent.
+    @wraps(handler)
+    async def wrapper(request, jwt, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return await handler(request, jwt, *args, **kwargs)
+        full_key, fingerprint, record = claim(
+            jwt, key, request.url.path, request.url.query.encode('utf-8'),
+            await request.body())
+        if record is not None:
+            return Response(record['body'], status_code=record['status'],
+                            media_type=record['mimetype'],
+                            headers={REPLAYED_HEADER: 'true'})
+        try:
+            response = await handler(request, jwt, *args, **kwargs)
+        except BaseException:
+            release(full_key)
+            raise
+        store_response(full_key, fingerprint, response.status_code,
+                       response.media_type, response.body.decode('utf-8'))
+        return response
+
+    return wrapper
+
+
+def wants_ndjson(request):
+    return prefers_ndjson(request.headers.get('accept'))
+
+
+async def table_version(table_name):
+    row = await database.fetch_one(version_query(table_name))
+    if row is None:
+        return 0, None
+    return row['version'], row['updated_at']
+
+
+async def bump_version(table_name):
+    # Call inside the write's transaction, as models.bump_version does.
+    now = datetime.utcnow()
+    if await database.fetch_one(version_query(table_name)) is None:
+        await database.execute(TableVersion.__table__.insert().values(
+            table_name=table_name, version=1, updated_at=now))
+        return 1, now
+    await database.execute(version_bump(table_name, now))
+    row = await database.fetch_one(version_query(table_name))
+    return row['version'], now
+
+
+async def publish(table_name, action, ids, version):
+    # Brokers may block on I/O (NOTIFY), so publish off the event loop.
+    await run_in_threadpool(publish_change, table_name, action, ids, version)
+
+
+async def add_tombstones(table_name, ids, version):
+    await database.execute_many(Tombstone.__table__.insert(),
+                                tombstone_rows(table_name, ids, version))
+
+
+async def cached_listing(request, table, build):
+    version, updated_at = await table_version(table.name)
+    tag = version_tag(version, updated_at)
+    resource = '%s?%s' % (request.url.path, request.url.query)
+    etag = '"%s"' % listing_etag(table.name, tag, resource)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    last_modified = settled_last_modified(updated_at)
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    conditional = {
+        'HTTP_IF_NONE_MATCH': request.headers.get('if-none-match'),
+        'HTTP_IF_MODIFIED_SINCE': request.headers.get('if-modified-since')
+    }
+    if not is_resource_modified(conditional, etag=etag,
+                                last_modified=last_modified):
+        return Response(status_code=304, headers=headers)
+    cache_key = listing_cache.key_for(
+        table.name, '%s:%s' % (tag, resource))
+    entry = listing_cache.get(cache_key)
+    if entry is None:
+        entry = {'body': (await build()).body.decode('utf-8')}
+        listing_cache.set(cache_key, entry)
+    return Response(entry['body'], media_type='application/json',
+                    headers=headers)
+
+
+'''
+AsyncMenuResource
+The async counterpart of resources.MenuResource, generated from the same
+MENU_RESOURCES registry.
+'''
+
+
+class AsyncMenuResource:
+    def __init__(self, resource):
+        self.table = resource.model.__table__
+        self.name = resource.name
+
+    async def list_items(self, request, jwt):
+        q = request.query_params.get('q', '').strip()
+        if q:
+            return await self.search_items(request, q)
+        if (request.query_params.get('stream') in ('1', 'true')
+                or wants_ndjson(request)):
+            return self.stream_items(request)
+        limit, cursor = parse_page_args(request.query_params)
+
+        async def build():
+            query = select([self.table.c.id, self.table.c.title]) \
+                .order_by(self.table.c.id).limit(limit + 1)
+            if cursor is not None:
+                query = query.where(self.table.c.id > cursor)
+            rows = await database.fetch_all(query)
+            next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+            return SortedJSONResponse(page_body(
+                self.name, [dict(row) for row in rows[:limit]], next_cursor))
+        return await cached_listing(request, self.table, build)
+
+    async def list_changes(self, request, jwt):
+        since = parse_since(request.query_params)
+
+        async def build():
+            version, _ = await table_version(self.table.name)
+            query = select([self.table.c.id, self.table.c.title]) \
+                .order_by(self.table.c.id)
+            if since:
+                # As in models.changes_since, a full sync is unfiltered.
+                query = query.where(self.table.c.version > since)
+            rows = await database.fetch_all(query)
+            deleted = []
+            if since:
+                tombstones = Tombstone.__table__
+                deleted = list(dict.fromkeys(
+                    row['item_id'] for row in await database.fetch_all(
+                        select([tombstones.c.item_id])
+                        .where(tombstones.c.table_name == self.table.name)
+                        .where(tombstones.c.version > since)
+                        .order_by(tombstones.c.version,
+                                  tombstones.c.item_id))))
+            return SortedJSONResponse(changes_body(
+                self.name, [(row['id'], row['title']) for row in rows],
+                deleted, version))
+        return await cached_listing(request, self.table, build)
+
+    async def search_items(self, request, q):
+        limit, offset = parse_search_args(request.query_params)
+
+        async def build():
+            if database.url.dialect == 'postgresql':
+                rows = await database.fetch_all(
+                    select([self.table.c.id, self.table.c.title])
+                    .where(title_matches(self.table, q))
+                    .order_by(*title_ranking(self.table, q))
+                    .limit(limit + 1).offset(offset))
+                matches = [(row['id'], row['title']) for row in rows]
+            else:
+                index = await self.title_index()
+                matches = index.search(q)[offset:offset + limit + 1]
+            next_offset = offset + limit if len(matches) > limit else None
+            return SortedJSONResponse(page_body(
+                self.name, [{'id': id, 'title': title}
+                            for id, title in matches[:limit]], next_offset))
+        return await cached_listing(request, self.table, build)
+
+    async def title_index(self):
+        version, _ = await table_version(self.table.name)
+        index = current_index(self.table.name, version)
+        if index is None:
+            rows = await database.fetch_all(
+                select([self.table.c.id, self.table.c.title]))
+            index = store_index(self.table.name, version,
+                                [(row['id'], row['title']) for row in rows])
+        return index
+
+    def stream_items(self, request):
+        ndjson = wants_ndjson(request)
+        query = select([self.table.c.id, self.table.c.title]) \
+            .order_by(self.table.c.id)
+
+        async def generate():
+            separator = b'\n' if ndjson else b','
+            if not ndjson:
+                yield b'{"%s":[' % self.name.encode('utf-8')
+            chunk = []
+            first = True
+            async for row in database.iterate(query):
+                chunk.append(dumps_compact(
+                    {'id': row['id'], 'title': row['title']}))
+                if len(chunk) == STREAM_CHUNK_ROWS:
+                    yield (b'' if first else separator) + separator.join(chunk)
+                    chunk = []
+                    first = False
+            if chunk:
+                yield (b'' if first else separator) + separator.join(chunk)
+                first = False
+            if ndjson:
+                if not first:
+                    yield b'\n'
+            else:
+                yield b'],"success":true}'
+
+        return StreamingResponse(
+            generate(),
+            media_type=NDJSON_MIMETYPE if ndjson else 'application/json')
+
+    async def find(self, id):
+        return await database.fetch_one(
+            select([self.table.c.id, self.table.c.title])
+            .where(self.table.c.id == id))
+
+    async def create_item(self, request, jwt):
+        body = await get_json(request)
+        if body is None:
+            abort(400)
+        if wants_upsert(request.query_params):
+            return await self.upsert_item(parse_upsert_title(body))
+        title = body.get('title')
+        async with database.transaction():
+            version, now = await bump_version(self.table.name)
+            await database.execute(self.table.insert().values(
+                title=title, version=version, updated_at=now))
+            row = await database.fetch_one(
+                select([self.table.c.id, self.table.c.title])
+                .where(self.table.c.title == title))
+        listing_cache.invalidate(self.table.name)
+        await publish(self.table.name, 'created', [row['id']], version)
+        return SortedJSONResponse({
+            'success': True,
+            self.name: [dict(row)]
+        })
+
+    async def upsert_item(self, title):
+        # As models.upsert: only a row actually inserted bumps the version.
+        dialect_name = database.url.dialect
+        statement = upsert_statement(self.table, title, dialect_name)
+        async with database.transaction():
+            if dialect_name == 'postgresql':
+                id = await database.fetch_val(statement)
+            else:
+                id = await database.execute(statement)
+                if not await database.fetch_val('SELECT changes()'):
+                    id = None
+            created = id is not None
+            if created:
+                version, now = await bump_version(self.table.name)
+                await database.execute(
+                    upsert_stamp(self.table, id, version, now))
+            else:
+                id = await database.fetch_val(
+                    upsert_lookup(self.table, title))
+        if created:
+            listing_cache.invalidate(self.table.name)
+            await publish(self.table.name, 'created', [id], version)
+        return SortedJSONResponse(upsert_body(self.name, id, title, created))
+
+    async def update_item(self, request, jwt):
+        id = request.path_params['id']
+        row = await self.find(id)
+        if row is None:
+            abort(404)
+        try:
+            body = await get_json(request)
+            new_title = body.get('title') or row['title']
+            async with database.transaction():
+                version, now = await bump_version(self.table.name)
+                await database.execute(self.table.update()
+                                       .where(self.table.c.id == row['id'])
+                                       .values(title=new_title,
+                                               version=version,
+                                               updated_at=now))
+        except Exception:
+            logger.exception('update of %s %s failed', self.name, id)
+            abort(422)
+        listing_cache.invalidate(self.table.name)
+        await publish(self.table.name, 'updated', [row['id']], version)
+        return SortedJSONResponse({
+            'success': True,
+            self.name: [{'id': row['id'], 'title': new_title}]
+        })
+
+    async def delete_item(self, request, jwt):
+        id = request.path_params['id']
+        row = await self.find(id)
+        if row is None:
+            abort(404)
+        try:
+            async with database.transaction():
+                version, _ = await bump_version(self.table.name)
+                await database.execute(
+                    self.table.delete().where(self.table.c.id == row['id']))
+                await add_tombstones(self.table.name, [row['id']], version)
+        except Exception:
+            abort(422)
+        listing_cache.invalidate(self.table.name)
+        await publish(self.table.name, 'deleted', [row['id']], version)
+        return SortedJSONResponse({
+            'success': True,
+            'delete': str(id)
+        })
+
+    async def create_items(self, request, jwt):
+        titles = parse_bulk_titles(await get_json(request))
+        valid = list(dict.fromkeys(
+            title for title in titles if isinstance(title, str) and title))
+        lookup = select([self.table.c.title, self.table.c.id]) \
+            .where(self.table.c.title.in_(valid))
+        # Retried as in models.bulk_insert when a concurrent writer claims
+        # a title between the lookup and the insert.
+        for attempt in range(BULK_INSERT_ATTEMPTS):
+            try:
+                async with database.transaction():
+                    existing = {row['title']: row['id']
+                                for row in await database.fetch_all(lookup)}
+                    new_titles = [title for title in valid
+                                  if title not in existing]
+                    if new_titles:
+                        version, now = await bump_version(self.table.name)
+                        await database.execute_many(
+                            self.table.insert(),
+                            [{'title': title, 'version': version,
+                              'updated_at': now} for title in new_titles])
+                    rows = await database.fetch_all(lookup)
+            except INTEGRITY_ERRORS:
+                if attempt == BULK_INSERT_ATTEMPTS - 1:
+                    raise
+                continue
+            break
+        inserted = {row['title']: (row['id'], row['title'] not in existing)
+                    for row in rows}
+        if new_titles:
+            listing_cache.invalidate(self.table.name)
+            await publish(self.table.name, 'created',
+                          sorted(id for id, is_new in inserted.values()
+                                 if is_new), version)
+        created, results = bulk_results(titles, inserted)
+        return SortedJSONResponse({
+            'success': True,
+            self.name: created,
+            'results': results
+        })
+
+    async def update_items(self, request, jwt):
+        titles_by_id = parse_bulk_renames(await get_json(request))
+        ids = list(titles_by_id)
+        try:
+            async with database.transaction():
+                updated = [row['id'] for row in await database.fetch_all(
+                    select([self.table.c.id])
+                    .where(self.table.c.id.in_(ids)))]
+                if updated:
+                    version, now = await bump_version(self.table.name)
+                    await database.execute(
+                        self.table.update()
+                        .where(self.table.c.id.in_(updated))
+                        .values(title=case(titles_by_id,
+                                           value=self.table.c.id),
+                                version=version, updated_at=now))
+        except Exception:
+            logger.exception('bulk update of %s failed', self.name)
+            abort(422)
+        listing_cache.invalidate(self.table.name)
+        if updated:
+            await publish(self.table.name, 'updated', updated, version)
+        found = set(updated)
+        return SortedJSONResponse({
+            'success': True,
+            self.name: [{'id': id, 'title': titles_by_id[id]}
+                        for id in updated],
+            'missing': [id for id in ids if id not in found]
+        })
+
+    async def delete_items(self, request, jwt):
+        ids = parse_bulk_ids(await get_json(request))
+        try:
+            async with database.transaction():
+                deleted = [row['id'] for row in await database.fetch_all(
+                    select([self.table.c.id])
+                    .where(self.table.c.id.in_(ids)))]
+                if deleted:
+                    version, _ = await bump_version(self.table.name)
+                    await database.execute(
+                        self.table.delete()
+                        .where(self.table.c.id.in_(deleted)))
+                    await add_tombstones(self.table.name, deleted, version)
+        except Exception:
+            logger.exception('bulk delete of %s failed', self.name)
+            abort(422)
+        listing_cache.invalidate(self.table.name)
+        if deleted:
+            await publish(self.table.name, 'deleted', deleted, version)
+        found = set(deleted)
+        return SortedJSONResponse({
+            'success': True,
+            'delete': deleted,
+            'missing': [id for id in ids if id not in found]
+        })
+
+    def routes(self):
+        prefix = '/' + self.name
+        routes = [
+            ('', 'GET', 'get', self.list_items),
+            ('/changes', 'GET', 'get', self.list_changes),
+            ('', 'POST', 'post', idempotent(self.create_item)),
+            ('/bulk', 'POST', 'post', idempotent(self.create_items)),
+            ('/bulk', 'PATCH', 'patch', self.update_items),
+            ('/bulk', 'DELETE', 'delete', self.delete_items),
+            ('/{id:int}', 'PATCH', 'patch', self.update_item),
+            ('/{id:int}', 'DELETE', 'delete', self.delete_item),
+        ]
+        return [
+            Route(prefix + rule,
+                  requires_auth_async('%s:%s' % (action, self.name))(handler),
+                  methods=[method])
+            for rule, method, action, handler in routes
+        ]
+
+
+async def menu_events(request, jwt):
+    tables = readable_tables(jwt)
+
+    async def generate():
+        # Subscribing here rather than in the handler means a response
+        # whose body is never sent holds no subscription.
+        subscriber = broker.subscribe(AsyncSubscriber(tables))
+        try:
+            yield RETRY
+            while not await request.is_disconnected():
+                events, overflowed = await subscriber.wait(EVENT_HEARTBEAT)
+                if overflowed:
+                    yield RESET
+                if events:
+                    yield b''.join(format_event(event) for event in events)
+                elif not overflowed:
+                    yield HEARTBEAT
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        generate(), media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+ERROR_MESSAGES = {
+    400: 'bad_request',
+    401: 'unauthorised',
+    404: 'resource not found',
+    429: 'too_many_requests',
+    503: 'service_unavailable',
+}
+
+
+async def auth_error(request, error):
+    return SortedJSONResponse({
+        'success': False,
+        'error': error.status_code,
+        'message': error.error
+    }, status_code=error.status_code)
+
+
+async def http_error(request, error):
+    status_code = getattr(error, 'status_code', None) or error.code
+    if status_code in ERROR_MESSAGES:
+        return SortedJSONResponse({
+            'success': False,
+            'error': status_code,
+            'message': ERROR_MESSAGES[status_code]
+        }, status_code=status_code, headers=retry_after_headers(error))
+    return SortedJSONResponse({'message': str(error)},
+                              status_code=status_code)
+
+
+async def server_error(request, error):
+    return SortedJSONResponse({'message': str(error)}, status_code=500)
+
+
+class AdmissionMiddleware:
+    # The async counterpart of the concurrency cap in
+    # ratelimit.init_rate_limiting: requests past the cap are refused
+    # before they wait on the connection pool.
+    def __init__(self, app, admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in ADMISSION_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        if not self.admission.admit():
+            response = SortedJSONResponse({
+                'success': False,
+                'error': 503,
+                'message': ERROR_MESSAGES[503]
+            }, status_code=503,
+                headers={'Retry-After': str(self.admission.retry_after)})
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release()
+
+
+def create_app(limiter=None, admission=None):
+    '''
+    Rate limiting and the concurrency cap are configured as for app.py;
+    the cap defaults to the async pool's max_size.
+    '''
+    if limiter is None:
+        limiter = rate_limiter_from_env()
+    if admission is None:
+        admission = admission_from_env(
+            pool_options(database_path).get('max_size'))
+    middleware = []
+    if admission is not None:
+        middleware.append(Middleware(AdmissionMiddleware,
+                                     admission=admission))
+    routes = []
+    for resource in MENU_RESOURCES:
+        routes.extend(AsyncMenuResource(resource).routes())
+    routes.append(Route(
+        '/menu/events',
+        requires_auth_async(*['get:%s' % resource.name
+                              for resource in MENU_RESOURCES],
+                            any_of=True)(menu_events)))
+    app = Starlette(
+        routes=routes,
+        middleware=middleware,
+        exception_handlers={
+            AuthError: auth_error,
+            HTTPException: http_error,
+            StarletteHTTPException: http_error,
+            Exception: server_error,
+        },
+        on_startup=[database.connect],
+        on_shutdown=[database.disconnect])
+    app.state.rate_limiter = limiter
+    app.state.admission = admission
+    return app
+
+
+app = create_app()
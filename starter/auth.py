@@ -1,14 +1,39 @@
+import asyncio
+import hashlib
 import json
+import os
+import sys
+import threading
+import time
 from functools import wraps
 from urllib.request import urlopen
 
 from flask import _request_ctx_stack, request
 from jose import jwt
 
+from cache import LRUCache
+from metrics import timed
+from ratelimit import check_rate_limit, check_rate_limit_async
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 AUTH0_DOMAIN = 'fsnd-aj.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffee'
 
+# JWKS_URL may point at a local file (file:///...) or stub server in tests.
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+RSA_KEY_FIELDS = ('kty', 'kid', 'use', 'n', 'e')
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -24,8 +49,11 @@ class AuthError(Exception):
 
 # Auth Header
 def get_token_auth_header():
-    auth_header = request.headers.get('Authorization', None)
+    with timed('auth_header'):
+        return parse_auth_header(request.headers.get('Authorization', None))
+
 
+def parse_auth_header(auth_header):
     if not auth_header:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -53,14 +81,51 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+'''
+RequiredPermissions
+The permissions an endpoint needs, resolved once when the endpoint is
+decorated. With any_of=True holding one of them is enough.
+'''
+
+
+class RequiredPermissions:
+    __slots__ = ('permissions', 'any_of')
+
+    def __init__(self, permissions=(), any_of=False):
+        if isinstance(permissions, str):
+            permissions = (permissions,)
+        self.permissions = frozenset(
+            sys.intern(permission) for permission in permissions
+            if permission)
+        self.any_of = any_of
+
+    def satisfied_by(self, granted):
+        if not self.permissions:
+            return True
+        if self.any_of:
+            return not self.permissions.isdisjoint(granted)
+        return self.permissions <= granted
+
+
+def granted_permissions(payload):
+    if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
+
+def check_permissions(permission, payload, granted=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in jwt.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if not isinstance(permission, RequiredPermissions):
+        permission = RequiredPermissions(permission)
+    if granted is None:
+        granted = granted_permissions(payload)
+
+    if not permission.satisfied_by(granted):
         raise AuthError({
             'code': 'unauthorised',
             'description': 'Permission not found'
@@ -69,37 +134,192 @@ def check_permissions(permission, payload):
     return True
 
 
+'''
+JWKS key store
+Signing keys are fetched once per process and shared by every request.
+The document is refetched when it is older than JWKS_CACHE_TTL, or early
+when a token names a kid we have not seen (key rotation), at most once per
+JWKS_MIN_REFRESH_INTERVAL. Concurrent refreshes collapse into one fetch.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+    def get_key(self, kid):
+        fetched_at = self._fetched_at
+        keys = self._keys
+        if fetched_at is None or time.monotonic() - fetched_at >= self.ttl:
+            keys = self.refresh(fetched_at)
+        elif kid not in keys:
+            keys = self.refresh(fetched_at, forced=True)
+        return keys.get(kid)
+
+    async def get_key_async(self, kid):
+        fetched_at = self._fetched_at
+        keys = self._keys
+        if fetched_at is None or time.monotonic() - fetched_at >= self.ttl:
+            keys = await self.refresh_async(fetched_at)
+        elif kid not in keys:
+            keys = await self.refresh_async(fetched_at, forced=True)
+        return keys.get(kid)
+
+    def refresh(self, seen_fetched_at, forced=False):
+        with self._lock:
+            if self._is_fresh(seen_fetched_at, forced):
+                return self._keys
+            try:
+                jwks = self.fetch()
+            except Exception:
+                jwks = None
+            return self._store(jwks)
+
+    async def refresh_async(self, seen_fetched_at, forced=False):
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self._is_fresh(seen_fetched_at, forced):
+                return self._keys
+            try:
+                jwks = await self.fetch_async()
+            except Exception:
+                jwks = None
+            with self._lock:
+                return self._store(jwks)
+
+    def _is_fresh(self, seen_fetched_at, forced):
+        # Another caller refreshed while we were waiting for the lock, or
+        # an unknown kid asked for a refetch too soon after the last one.
+        if self._fetched_at != seen_fetched_at:
+            return True
+        return forced and (time.monotonic() - self._fetched_at
+                           < self.min_refresh_interval)
+
+    def _store(self, jwks):
+        now = time.monotonic()
+        if jwks is not None:
+            self._keys = self.load_keys(jwks)
+        elif not self._keys:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch signing keys.'
+            }, 503)
+        else:
+            # Keep serving the keys we have and retry shortly.
+            now -= max(self.ttl - self.min_refresh_interval, 0)
+        self._fetched_at = now
+        return self._keys
+
+    def fetch(self):
+        self.fetch_count += 1
+        with timed('jwks_fetch'), \
+                urlopen(self.url, timeout=self.timeout) as jsonurl:
+            return json.loads(jsonurl.read())
+
+    async def fetch_async(self):
+        if httpx is None or not self.url.startswith(('http://', 'https://')):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, self.fetch)
+        self.fetch_count += 1
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            response = await client.get(self.url)
+            response.raise_for_status()
+            return response.json()
+
+    @staticmethod
+    def load_keys(jwks):
+        # Keys that cannot verify RS256 signatures (encryption keys, other
+        # key types, entries missing a field) are skipped rather than
+        # failing the whole document. `use` is optional (RFC 7517).
+        return {
+            key['kid']: {field: key[field] for field in RSA_KEY_FIELDS
+                         if field in key}
+            for key in jwks.get('keys', [])
+            if key.get('kty') == 'RSA' and key.get('use', 'sig') == 'sig'
+            and all(key.get(field) for field in ('kid', 'n', 'e'))
+        }
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+
+'''
+Verified token cache
+Decoded payloads, with their permissions as a frozenset, keyed by the
+token's SHA-256 digest, so a bearer token reused across requests is only
+signature-checked once. Entries expire at the token's own exp claim;
+tokens without one are not cached.
+'''
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return verify_token(token)[0]
+
+
+def verify_token(token):
+    digest = token_digest(token)
+    verified = token_cache.get(digest)
+    if verified is not None:
+        return verified
+    rsa_key = jwks_store.get_key(unverified_kid(token))
+    return decode_token(token, digest, rsa_key)
+
+
+async def verify_token_async(token):
+    digest = token_digest(token)
+    verified = token_cache.get(digest)
+    if verified is not None:
+        return verified
+    rsa_key = await jwks_store.get_key_async(unverified_kid(token))
+    return decode_token(token, digest, rsa_key)
+
+
+def unverified_kid(token):
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+
+def decode_token(token, digest, rsa_key):
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with timed('auth_verify'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
-            return payload
+            verified = (payload, granted_permissions(payload))
+            if isinstance(payload.get('exp'), (int, float)):
+                token_cache.set(digest, verified, expires_at=payload['exp'])
+            return verified
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -124,14 +344,33 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+def requires_auth(*permissions, any_of=False):
+    required = RequiredPermissions(permissions, any_of=any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, granted = verify_token(token)
+            check_rate_limit(payload)
+            check_permissions(required, payload, granted)
             return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
+
+
+def requires_auth_async(*permissions, any_of=False):
+    required = RequiredPermissions(permissions, any_of=any_of)
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request, *args, **kwargs):
+            token = parse_auth_header(request.headers.get('Authorization'))
+            payload, granted = await verify_token_async(token)
+            await check_rate_limit_async(request, payload)
+            check_permissions(required, payload, granted)
+            return await f(request, payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
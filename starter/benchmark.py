@@ -0,0 +1,300 @@
+"""Load and latency benchmarks for the menu API hot paths.
+
+Runs create_app() in-process against a throwaway SQLite database (or the
+database given with --database) and a locally generated RSA key served as
+a JWKS file, so no Auth0 tenant or live tokens are needed. Every scenario
+is measured at each table size and concurrency level and the results are
+written as JSON, ready to diff between releases:
+
+    python benchmark.py --sizes 100,10000 --concurrency 1,8 -o bench.json
+
+With --profile-sql each result also records the SQL statements issued per
+request, so a change that adds queries to a hot path shows up in the diff.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ['list', 'list_uncached', 'list_page', 'search', 'create',
+             'patch', 'delete', 'auth_cold']
+PERMISSIONS = ['%s:%s' % (action, name)
+               for action in ('get', 'post', 'patch', 'delete')
+               for name in ('drinks', 'desserts')]
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def make_signing_key(workdir):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                   backend=default_backend())
+    numbers = key.public_key().public_numbers()
+    jwks_path = os.path.join(workdir, 'jwks.json')
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump({'keys': [{
+            'kty': 'RSA', 'kid': 'benchmark', 'use': 'sig', 'alg': 'RS256',
+            'n': b64_int(numbers.n), 'e': b64_int(numbers.e)
+        }]}, jwks_file)
+    pem = key.private_bytes(serialization.Encoding.PEM,
+                            serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+    return pem, 'file://' + jwks_path
+
+
+def make_token(pem, subject='benchmark'):
+    from jose import jwt
+
+    import auth
+
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'aud': auth.API_AUDIENCE,
+        'sub': subject,
+        'iat': now,
+        'exp': now + 3600,
+        'permissions': PERMISSIONS
+    }, pem, algorithm='RS256', headers={'kid': 'benchmark'})
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class Benchmark:
+    def __init__(self, app, pem, requests, warmup):
+        self.app = app
+        self.pem = pem
+        self.requests = requests
+        self.warmup = warmup
+        self.headers = {'Authorization': 'Bearer ' + make_token(pem)}
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def unique(self, prefix):
+        with self._lock:
+            self._counter += 1
+            return '%s %d %d' % (prefix, os.getpid(), self._counter)
+
+    def seed(self, size):
+        from models import Drink, bulk_insert, create_tables, db
+
+        with self.app.app_context():
+            db.drop_all()
+            create_tables()
+            for start in range(0, size, 1000):
+                bulk_insert(Drink, ['drink %d' % i for i in
+                                    range(start, min(start + 1000, size))])
+
+    def ids(self, count):
+        from models import Drink, bulk_insert
+
+        with self.app.app_context():
+            inserted = bulk_insert(
+                Drink, [self.unique('target') for _ in range(count)])
+        return [id for id, _ in inserted.values()]
+
+    def prepare(self, scenario, count):
+        # Returns a function issuing one request with a test client.
+        from auth import token_cache
+        from cache import listing_cache
+
+        headers = self.headers
+        if scenario == 'list':
+            return lambda client: client.get('/drinks', headers=headers)
+        if scenario == 'list_uncached':
+            def request(client):
+                listing_cache.invalidate('drink')
+                return client.get('/drinks', headers=headers)
+            return request
+        if scenario == 'list_page':
+            return lambda client: client.get('/drinks?limit=20&cursor=10',
+                                             headers=headers)
+        if scenario == 'search':
+            return lambda client: client.get('/drinks?q=drink 1&limit=20',
+                                             headers=headers)
+        if scenario == 'create':
+            return lambda client: client.post(
+                '/drinks', json={'title': self.unique('created')},
+                headers=headers)
+        if scenario == 'patch':
+            targets = iter(self.ids(count))
+
+            def request(client):
+                with self._lock:
+                    id = next(targets)
+                return client.patch('/drinks/%d' % id,
+                                    json={'title': self.unique('patched')},
+                                    headers=headers)
+            return request
+        if scenario == 'delete':
+            targets = iter(self.ids(count))
+
+            def request(client):
+                with self._lock:
+                    id = next(targets)
+                return client.delete('/drinks/%d' % id, headers=headers)
+            return request
+        if scenario == 'auth_cold':
+            def request(client):
+                token_cache.clear()
+                return client.get('/drinks?limit=1', headers=headers)
+            return request
+        raise ValueError('unknown scenario %r' % scenario)
+
+    def measure(self, scenario, concurrency):
+        total = self.warmup + self.requests
+        request = self.prepare(scenario, total)
+        profiler = self.app.extensions.get('sql_profiler')
+        if profiler is not None:
+            profiler.reset()
+        latencies = []
+        errors = [0]
+        record = threading.Lock()
+        issued = iter(range(total))
+
+        def worker():
+            client = self.app.test_client()
+            while True:
+                with record:
+                    n = next(issued, None)
+                if n is None:
+                    return
+                started = time.perf_counter()
+                response = request(client)
+                elapsed = time.perf_counter() - started
+                with record:
+                    if n >= self.warmup:
+                        latencies.append(elapsed)
+                        if response.status_code >= 400:
+                            errors[0] += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            workers = [pool.submit(worker) for _ in range(concurrency)]
+        for finished in workers:
+            finished.result()
+        wall = time.perf_counter() - started
+        latencies.sort()
+        result = {
+            'requests': len(latencies),
+            'errors': errors[0],
+            'rps': round(total / wall, 1) if wall else None,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3)
+        }
+        if profiler is not None:
+            routes = profiler.report().values()
+            result['queries_per_request'] = round(
+                sum(route['queries'] for route in routes)
+                / max(sum(route['requests'] for route in routes), 1), 2)
+            result['max_queries'] = max(
+                [route['max_queries'] for route in routes] or [0])
+        return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated table sizes')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma separated client thread counts')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per run')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests issued first')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--database',
+                        help='database URL (default: temporary SQLite file);'
+                             ' every table in it is dropped before each run,'
+                             ' so it also needs --allow-drop')
+    parser.add_argument('--allow-drop', action='store_true',
+                        help='allow dropping the tables of --database')
+    parser.add_argument('--profile-sql', action='store_true',
+                        help='record SQL statements issued per request')
+    parser.add_argument('-o', '--output', help='write JSON results here')
+    args = parser.parse_args(argv)
+    if args.database and not args.allow_drop:
+        parser.error('--database is dropped and reseeded before each run; '
+                     'pass --allow-drop if that is what you want')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='capstone-bench-')
+    pem, jwks_url = make_signing_key(workdir)
+
+    # app, auth and models read their configuration at import time.
+    os.environ['DATABASE_URL'] = args.database or (
+        'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ['JWKS_URL'] = jwks_url
+    os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.invalid')
+    os.environ.setdefault('MAX_PAGE_SIZE', '100')
+    if args.profile_sql:
+        os.environ['SQL_PROFILE'] = '1'
+
+    from app import create_app
+
+    app = create_app()
+    bench = Benchmark(app, pem, args.requests, args.warmup)
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for concurrency in [int(n) for n in args.concurrency.split(',')]:
+            for scenario in args.scenarios.split(','):
+                bench.seed(size)
+                result = bench.measure(scenario, concurrency)
+                result.update(scenario=scenario, rows=size,
+                              concurrency=concurrency)
+                results.append(result)
+                print('%-14s rows=%-7d c=%-3d %8.1f req/s  p50 %7.2fms  '
+                      'p99 %7.2fms  errors %d' % (
+                          scenario, size, concurrency, result['rps'],
+                          result['p50_ms'], result['p99_ms'],
+                          result['errors']), file=sys.stderr)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+        'timestamp': int(time.time()),
+        'results': results
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
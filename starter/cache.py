@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+'''
+LRUCache
+A bounded, thread-safe least-recently-used cache. Each entry may carry
+its own expiry time; expired entries are dropped when they are read.
+'''
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or self._clock() < expires_at:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at=None, ttl=None):
+        expires_at = self._expiry(expires_at, ttl)
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def add(self, key, value, expires_at=None, ttl=None):
+        '''
+        Stores the value only when the key is missing or expired, and
+        returns whether it did.
+        '''
+        expires_at = self._expiry(expires_at, ttl)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or
+                                      self._clock() < entry[1]):
+                return False
+            self._store(key, value, expires_at)
+            return True
+
+    def _expiry(self, expires_at, ttl):
+        ttl = ttl if ttl is not None else self.ttl
+        if ttl is not None:
+            ttl_expiry = self._clock() + ttl
+            expires_at = (ttl_expiry if expires_at is None
+                          else min(expires_at, ttl_expiry))
+        return expires_at
+
+    def _store(self, key, value, expires_at):
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+'''
+Cache backends
+Anything with get/set/delete/clear can back the response cache; `add`
+(set if missing) is only needed by the idempotency store. Values are
+plain JSON-compatible objects so shared backends can store them.
+'''
+
+
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LocalCacheBackend(CacheBackend):
+    def __init__(self, maxsize=1024, ttl=None):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl=ttl)
+
+    def add(self, key, value, ttl=None):
+        return self.cache.add(key, value, ttl=ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RedisCacheBackend(CacheBackend):
+    def __init__(self, url, ttl=None, prefix='capstone:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value),
+                        ex=ttl if ttl is not None else self.ttl)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(
+            self.prefix + key, json.dumps(value),
+            ex=ttl if ttl is not None else self.ttl, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def backend_from_url(url=None, maxsize=1024, ttl=None):
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCacheBackend(url, ttl=ttl)
+    return LocalCacheBackend(maxsize=maxsize, ttl=ttl)
+
+
+'''
+ResponseCache
+Serialized responses grouped by namespace (one per table). Invalidating
+a namespace swaps its generation token, which orphans every key built
+from the old one; a generation lost to eviction is replaced by a fresh
+token, so stale entries can never be read back.
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generation(self, namespace):
+        generation = self.backend.get('generation:' + namespace)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set('generation:' + namespace, generation)
+        return generation
+
+    def key_for(self, namespace, key):
+        return '%s:%s:%s' % (namespace, self.generation(namespace), key)
+
+    def get(self, full_key):
+        return self.backend.get(full_key)
+
+    def set(self, full_key, value):
+        self.backend.set(full_key, value)
+
+    def invalidate(self, namespace):
+        self.backend.set('generation:' + namespace, uuid.uuid4().hex)
+
+    def clear(self):
+        self.backend.clear()
+
+
+listing_cache = ResponseCache(backend_from_url(
+    os.environ.get('CACHE_URL'),
+    maxsize=int(os.environ.get('CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('CACHE_TTL', 300))))
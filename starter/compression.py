@@ -0,0 +1,136 @@
+import os
+import zlib
+
+from flask import request
+from werkzeug.wsgi import ClosingIterator
+
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+Bodies are compressed with brotli or gzip, whichever the client prefers in
+Accept-Encoding (brotli only when the module is installed). Bodies smaller
+than COMPRESS_MIN_SIZE are sent as they are, as are server-sent events and
+responses that are already encoded. Streamed listings are compressed chunk
+by chunk, so rows still reach the client as they are read.
+'''
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'application/json', 'application/x-ndjson', 'application/javascript',
+    'text/css', 'text/html', 'text/plain'
+])
+
+ENCODINGS = ['gzip']
+if brotli is not None:
+    ENCODINGS.insert(0, 'br')
+
+
+def negotiate_encoding(accept_encodings, encodings=ENCODINGS):
+    # best_match honours q-values, including q=0 refusals; on a tie the
+    # first of `encodings` wins.
+    return accept_encodings.best_match(encodings)
+
+
+def gzip_compressor():
+    # wbits=31 writes a gzip header and trailer around the deflate stream.
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = gzip_compressor()
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    # Flushes after every chunk so each one can be decoded on arrival.
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = gzip_compressor()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def weaken_etag(response):
+    # Each encoding is a different byte sequence, so a strong validator
+    # can no longer be shared between them. A weak one still answers
+    # If-None-Match, which uses the weak comparison.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+'''
+Compressor
+Compresses responses in an after_request hook. The compressed form of a
+response with a strong ETag (the cached listings) is kept in an
+in-process LRU keyed by ETag and encoding, so a hot listing is
+compressed once per version rather than once per request.
+'''
+
+
+class Compressor:
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, cache_size=256):
+        self.min_size = min_size
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def compressed_body(self, response, encoding):
+        etag, weak = response.get_etag()
+        if not etag or weak:
+            return compress(response.get_data(), encoding)
+        key = '%s:%s' % (etag, encoding)
+        body = self.cache.get(key)
+        if body is None:
+            body = compress(response.get_data(), encoding)
+            self.cache.set(key, body)
+        return body
+
+    def process_response(self, response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES and \
+                response.status_code != 304:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding is None or 'Content-Encoding' in response.headers:
+            return response
+        if response.status_code == 304:
+            weaken_etag(response)
+            return response
+        if response.status_code < 200 or response.status_code in (204, 206) \
+                or response.direct_passthrough:
+            return response
+        if response.is_streamed:
+            chunks = response.response
+            response.response = ClosingIterator(
+                compress_stream(chunks, encoding),
+                [chunks.close] if hasattr(chunks, 'close') else None)
+            response.headers.pop('Content-Length', None)
+        else:
+            if len(response.get_data()) < self.min_size:
+                return response
+            response.set_data(self.compressed_body(response, encoding))
+        response.headers['Content-Encoding'] = encoding
+        weaken_etag(response)
+        return response
+
+
+def init_compression(app, compressor=None):
+    compressor = compressor or Compressor()
+    app.extensions['compressor'] = compressor
+    app.after_request(compressor.process_response)
+    return compressor
@@ -5,6 +5,9 @@ AUTH0_CLIENT_SECRET = 'AUTH0_CLIENT_SECRET'
 AUTH0_CALLBACK_URL = 'AUTH0_CALLBACK_URL'
 AUTH0_DOMAIN = 'AUTH0_DOMAIN'
 AUTH0_AUDIENCE = 'AUTH0_AUDIENCE'
+MAX_PAGE_SIZE = 'MAX_PAGE_SIZE'
+MAX_BULK_SIZE = 'MAX_BULK_SIZE'
+MAX_EVENT_SUBSCRIBERS = 'MAX_EVENT_SUBSCRIBERS'
 PROFILE_KEY = 'profile'
 SECRET_KEY = 'ThisIsTheSecretKey'
 JWT_PAYLOAD = 'jwt_payload'
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+import select
+import sys
+import threading
+import time
+from collections import deque
+
+'''
+Menu events
+Every committed write publishes one event naming the table, the action
+(created, updated or deleted), the ids touched and the table version it
+produced. Subscribers of GET /menu/events receive them as server-sent
+events. Clients that fall behind, or reconnect, catch up through
+GET /<name>/changes?since=<version>.
+'''
+
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', 64))
+EVENT_HEARTBEAT = float(os.environ.get('EVENT_HEARTBEAT', 15))
+EVENT_CHANNEL = 'menu_events'
+# NOTIFY payloads must stay under 8000 bytes.
+MAX_PAYLOAD = 7900
+
+
+def menu_event(table_name, action, ids, version):
+    return {
+        'table': table_name,
+        'action': action,
+        'ids': list(ids),
+        'version': version
+    }
+
+
+def format_event(event):
+    return ('id: %s:%d\nevent: %s.%s\ndata: %s\n\n' % (
+        event['table'], event['version'], event['table'], event['action'],
+        json.dumps(event, sort_keys=True, separators=(',', ':'))
+    )).encode('utf-8')
+
+
+RETRY = b'retry: 3000\n\n'
+HEARTBEAT = b': keepalive\n\n'
+RESET = b'event: reset\ndata: {}\n\n'
+
+
+'''
+Subscriber
+One client's queue of undelivered events, limited to EVENT_BUFFER_SIZE.
+A subscriber that falls further behind is not waited for: its buffer is
+dropped and it receives a single `reset` event, after which the client
+resynchronizes through the changes endpoint.
+'''
+
+
+class Subscriber:
+    def __init__(self, tables, maxsize=EVENT_BUFFER_SIZE):
+        self.tables = frozenset(tables)
+        self.maxsize = maxsize
+        self.overflowed = False
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def put(self, event):
+        if event['table'] not in self.tables:
+            return
+        with self._lock:
+            if len(self._events) >= self.maxsize:
+                self._events.clear()
+                self.overflowed = True
+            else:
+                self._events.append(event)
+        self._wake()
+
+    def drain(self):
+        '''
+        Returns the buffered events and whether any were dropped since the
+        last call.
+        '''
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+            overflowed, self.overflowed = self.overflowed, False
+            self._ready.clear()
+        return events, overflowed
+
+    def _wake(self):
+        self._ready.set()
+
+    def wait(self, timeout):
+        self._ready.wait(timeout)
+        return self.drain()
+
+
+class AsyncSubscriber(Subscriber):
+    # Woken from whichever thread publishes, so the wake-up is scheduled
+    # on the subscriber's own event loop.
+    def __init__(self, tables, maxsize=EVENT_BUFFER_SIZE):
+        super().__init__(tables, maxsize)
+        self._loop = asyncio.get_event_loop()
+        self._async_ready = asyncio.Event()
+
+    def _wake(self):
+        self._loop.call_soon_threadsafe(self._async_ready.set)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._async_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._async_ready.clear()
+        return self.drain()
+
+
+'''
+Brokers
+A broker fans events out to the subscribers of this process. LocalBroker
+only sees events published by this process; PostgresBroker relays them
+through LISTEN/NOTIFY so every worker sees every write.
+'''
+
+
+class Broker:
+    def __init__(self):
+        self.subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def deliver(self, event):
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def publish(self, event):
+        raise NotImplementedError
+
+
+class LocalBroker(Broker):
+    def publish(self, event):
+        self.deliver(event)
+
+
+class PostgresBroker(Broker):
+    def __init__(self, url, channel=EVENT_CHANNEL):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._connection = None
+        self._publish_lock = threading.Lock()
+        self._listener = None
+
+    def connect(self):
+        import psycopg2
+
+        connection = psycopg2.connect(self.url)
+        connection.autocommit = True
+        return connection
+
+    def publish(self, event):
+        payload = json.dumps(event, sort_keys=True, separators=(',', ':'))
+        if len(payload.encode('utf-8')) > MAX_PAYLOAD:
+            # Too many ids for one notification; send the version only.
+            payload = json.dumps(dict(event, ids=None), sort_keys=True,
+                                 separators=(',', ':'))
+        with self._publish_lock:
+            try:
+                if self._connection is None or self._connection.closed:
+                    self._connection = self.connect()
+                with self._connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_notify(%s, %s)',
+                                   (self.channel, payload))
+            except Exception as e:
+                # The write is committed; a lost event only delays clients
+                # until their next resync.
+                print('event publish failed: %s' % e, file=sys.stderr)
+                self._connection = None
+
+    def subscribe(self, subscriber):
+        # The LISTEN connection is opened by the first subscriber, so
+        # workers nobody subscribes to hold no extra connection.
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self.listen, name='menu-events', daemon=True)
+                self._listener.start()
+        return super().subscribe(subscriber)
+
+    def listen(self):
+        while True:
+            try:
+                connection = self.connect()
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN %s' % self.channel)
+                while True:
+                    if select.select([connection], [], [], 5) == \
+                            ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        self.deliver(json.loads(notify.payload))
+            except Exception as e:
+                print('event listener reconnecting: %s' % e,
+                      file=sys.stderr)
+                time.sleep(1)
+
+
+def broker_from_url(url=None):
+    if url and url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBroker(url)
+    return LocalBroker()
+
+
+broker = broker_from_url(os.environ.get('EVENTS_URL'))
+
+
+def publish_change(table_name, action, ids, version):
+    if ids:
+        broker.publish(menu_event(table_name, action, ids, version))
@@ -0,0 +1,116 @@
+import hashlib
+import os
+from functools import wraps
+
+from flask import Response, abort, request
+from werkzeug.exceptions import Conflict
+
+from cache import backend_from_url
+
+'''
+Idempotency keys
+A POST sent with an `Idempotency-Key` header is carried out once. Its
+response is stored under the key, scoped to the caller and the path, and
+every retry with the same key, query string and body is answered from
+the store without touching the database. The same key with a different
+request is refused with 422; a retry arriving while the first attempt is
+still running gets 409.
+'''
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+# A claim left by a worker that died mid-request frees the key again
+# after this long.
+IN_PROGRESS_TTL = 60
+
+idempotency_store = backend_from_url(
+    os.environ.get('IDEMPOTENCY_URL', os.environ.get('CACHE_URL')),
+    maxsize=int(os.environ.get('IDEMPOTENCY_STORE_SIZE', 10000)),
+    ttl=IDEMPOTENCY_TTL)
+
+
+def request_fingerprint(query_string, body):
+    # The query string selects the behaviour (?upsert=1), so it is part of
+    # what a retry has to repeat.
+    return hashlib.sha256(query_string + b'?' + body).hexdigest()
+
+
+def stored_key(jwt, path, key):
+    return 'idempotency:%s:%s:%s' % (jwt.get('sub', ''), path, key)
+
+
+def claim(jwt, key, path, query_string, body):
+    '''
+    Claims `key` for this request. Returns (stored key, fingerprint,
+    record): record is the stored response to replay, or None when the
+    request should run and its response be saved with store_response.
+    '''
+    if not key or len(key) > MAX_KEY_LENGTH:
+        abort(400)
+    full_key = stored_key(jwt, path, key)
+    fingerprint = request_fingerprint(query_string, body)
+    if idempotency_store.add(
+            full_key, {'fingerprint': fingerprint, 'status': None},
+            ttl=IN_PROGRESS_TTL):
+        return full_key, fingerprint, None
+    record = idempotency_store.get(full_key)
+    if record is None:
+        # Expired since the claim failed; the caller may retry.
+        raise Conflict()
+    if record['fingerprint'] != fingerprint:
+        abort(422)
+    if record['status'] is None:
+        raise Conflict()
+    return full_key, fingerprint, record
+
+
+def store_response(full_key, fingerprint, status, mimetype, body):
+    # 5xx responses release the key so the request can be retried.
+    if status >= 500:
+        release(full_key)
+        return
+    idempotency_store.set(full_key, {
+        'fingerprint': fingerprint,
+        'status': status,
+        'mimetype': mimetype,
+        'body': body
+    })
+
+
+def release(full_key):
+    idempotency_store.delete(full_key)
+
+
+def replay(record):
+    response = Response(record['body'], status=record['status'],
+                        mimetype=record['mimetype'])
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(f):
+    '''
+    Wraps a view taking the verified token payload first, as
+    requires_auth passes it.
+    '''
+    @wraps(f)
+    def wrapper(jwt, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return f(jwt, *args, **kwargs)
+        full_key, fingerprint, record = claim(
+            jwt, key, request.path, request.query_string, request.get_data())
+        if record is not None:
+            return replay(record)
+        try:
+            response = f(jwt, *args, **kwargs)
+        except BaseException:
+            release(full_key)
+            raise
+        store_response(full_key, fingerprint, response.status_code,
+                       response.mimetype, response.get_data(as_text=True))
+        return response
+
+    return wrapper
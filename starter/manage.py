@@ -1,8 +1,10 @@
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import Migrate, MigrateCommand, stamp
 from flask_script import Manager
 
 from app import app
-from models import db
+from models import create_tables, db
+from resources import MENU_RESOURCES
+from search import create_search_indexes
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +12,14 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def create_db():
+    """Create the schema from the models and mark migrations as applied"""
+    create_tables()
+    create_search_indexes(
+        db.engine, [resource.model for resource in MENU_RESOURCES])
+    stamp()
+
+
 if __name__ == '__main__':
     manager.run()
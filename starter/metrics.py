@@ -0,0 +1,200 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Metrics
+Request latency histograms broken down by route and status, plus the
+time each request spent in named phases (auth_header, jwks_fetch,
+auth_verify, db, serialize). Everything is kept in process and rendered
+in the Prometheus text format by GET /metrics.
+'''
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = [(key, list(counts), total, count)
+                      for key, (counts, total, count) in self._series.items()]
+        for label_values, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                           counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labels, label_values,
+                                  'le="%s"' % format_value(bound)),
+                    cumulative))
+            labels = format_labels(self.labels, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels, repr(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Collector:
+    '''
+    Counters and gauges read from elsewhere (pool, caches) at scrape time.
+    `collect` returns (label values, value) pairs.
+    '''
+
+    def __init__(self, name, description, kind, collect, labels=()):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.collect = collect
+        self.labels = tuple(labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for label_values, value in self.collect():
+            lines.append('%s%s %s' % (
+                self.name, format_labels(self.labels, label_values),
+                format_value(value)))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        for registered in self.metrics:
+            if registered.name == metric.name:
+                return registered
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_latency = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request.',
+    labels=('method', 'route', 'status')))
+phase_latency = registry.register(Histogram(
+    'http_request_phase_seconds',
+    'Time a request spent in each phase (auth, db, serialization).',
+    labels=('route', 'phase')))
+
+
+@contextmanager
+def timed(phase):
+    # Adds the block's duration to the current request's phase totals.
+    # Outside a Flask app context (the ASGI app, scripts) it only runs it.
+    if not has_app_context():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - started)
+
+
+def add_phase_time(phase, seconds):
+    phases = g.setdefault('metrics_phases', {})
+    phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['query_started'].pop()
+    if has_app_context():
+        add_phase_time('db', time.perf_counter() - started)
+
+
+def route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def asgi_route_label(request):
+    # Starlette records the matched route's endpoint, not the route.
+    endpoint = request.scope.get('endpoint')
+    for route in request.app.routes:
+        if getattr(route, 'endpoint', None) is endpoint:
+            return route.path
+    return 'unmatched'
+
+
+def init_metrics(app, collectors=()):
+    for collector in collectors:
+        registry.register(collector)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('metrics_started')
+        if started is None or request.path == '/metrics':
+            return response
+        route = route_label()
+        request_latency.observe(time.perf_counter() - started,
+                                request.method, route, response.status_code)
+        for phase, seconds in g.get('metrics_phases', {}).items():
+            phase_latency.observe(seconds, route, phase)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,33 @@
+"""drink and dessert tables
+
+Revision ID: 1c7e5a9f2d40
+Revises: 
+Create Date: 2020-12-27 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1c7e5a9f2d40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The tables as the first release created them; the title constraints
+    # follow in 88010898d0ca.
+    for table in ('drink', 'dessert'):
+        op.create_table(
+            table,
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('dessert')
+    op.drop_table('drink')
@@ -0,0 +1,37 @@
+"""per-table version counter for conditional listings
+
+Revision ID: 5b8e4d2c7a61
+Revises: 3f1c2a7d9b10
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e4d2c7a61'
+down_revision = '3f1c2a7d9b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    menu_version = op.create_table(
+        'menu_version',
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(menu_version, [
+        {'table_name': 'drink', 'version': 0, 'updated_at': now},
+        {'table_name': 'dessert', 'version': 0, 'updated_at': now},
+    ])
+
+
+def downgrade():
+    op.drop_table('menu_version')
@@ -1,7 +1,7 @@
 """empty message
 
 Revision ID: 88010898d0ca
-Revises: 
+Revises: 1c7e5a9f2d40
 Create Date: 2020-12-27 18:29:27.371649
 
 """
@@ -11,20 +11,22 @@ import sqlalchemy as sa
 
 # revision identifiers, used by Alembic.
 revision = '88010898d0ca'
-down_revision = None
+down_revision = '1c7e5a9f2d40'
 branch_labels = None
 depends_on = None
 
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.create_unique_constraint(None, 'dessert', ['title'])
-    op.create_unique_constraint(None, 'drink', ['title'])
-    # ### end Alembic commands ###
+    # Batch mode lets SQLite, which cannot ALTER constraints, copy the
+    # table instead; the names are the ones PostgreSQL picks by default.
+    with op.batch_alter_table('dessert') as batch_op:
+        batch_op.create_unique_constraint('dessert_title_key', ['title'])
+    with op.batch_alter_table('drink') as batch_op:
+        batch_op.create_unique_constraint('drink_title_key', ['title'])
 
 
 def downgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_constraint(None, 'drink', type_='unique')
-    op.drop_constraint(None, 'dessert', type_='unique')
-    # ### end Alembic commands ###
+    with op.batch_alter_table('drink') as batch_op:
+        batch_op.drop_constraint('drink_title_key', type_='unique')
+    with op.batch_alter_table('dessert') as batch_op:
+        batch_op.drop_constraint('dessert_title_key', type_='unique')
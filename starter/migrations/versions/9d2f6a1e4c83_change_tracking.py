@@ -0,0 +1,44 @@
+"""row versions and tombstones for delta sync
+
+Revision ID: 9d2f6a1e4c83
+Revises: 5b8e4d2c7a61
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2f6a1e4c83'
+down_revision = '5b8e4d2c7a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('drink', 'dessert'):
+        op.add_column(table, sa.Column('version', sa.Integer(),
+                                       server_default='0', nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                       nullable=True))
+        op.create_index('ix_%s_version' % table, table, ['version'])
+    op.create_table(
+        'menu_tombstone',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('item_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_menu_tombstone_version', 'menu_tombstone',
+                    ['table_name', 'version'])
+
+
+def downgrade():
+    op.drop_index('ix_menu_tombstone_version', table_name='menu_tombstone')
+    op.drop_table('menu_tombstone')
+    for table in ('dessert', 'drink'):
+        op.drop_index('ix_%s_version' % table, table_name=table)
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
@@ -1,61 +1,568 @@
 import json
 import os
+import threading
+import time
+from datetime import datetime
 
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, create_engine
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import (Column, DateTime, Integer, String, case, create_engine,
+                        event, orm, select)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.pool import NullPool, Pool
+from sqlalchemy.sql.expression import UpdateBase
+
+from cache import listing_cache
+from events import publish_change
 
 database_path = os.environ['DATABASE_URL']
 
-db = SQLAlchemy()
+
+'''
+Read replicas
+GET and HEAD requests read from a replica, picked round-robin once per
+request. A replica that cannot be reached is skipped for
+REPLICA_RETRY_INTERVAL seconds; with none reachable, reads go to the
+primary. Writes, and every read that follows a write in the same
+request, use the primary.
+'''
+
+
+class ReplicaSet:
+    def __init__(self, engines, retry_interval=30, clock=time.monotonic):
+        self.engines = list(engines)
+        self.retry_interval = retry_interval
+        self._clock = clock
+        self._down_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        # Healthy replicas, starting from the next one in rotation.
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.engines)
+            now = self._clock()
+            ordered = self.engines[start:] + self.engines[:start]
+            return [engine for engine in ordered
+                    if self._down_until.get(engine, 0) <= now]
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = self._clock() + self.retry_interval
+
+    def is_up(self, engine):
+        return self._down_until.get(engine, 0) <= self._clock()
+
+    def connect(self):
+        '''
+        Returns a connection to the next reachable replica, or None when
+        every replica is down.
+        '''
+        for engine in self.candidates():
+            try:
+                return engine.connect()
+            except DBAPIError:
+                self.mark_down(engine)
+        return None
+
+
+def replica_connection():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return None
+    if g.get('db_primary'):
+        return None
+    if 'db_replica' not in g:
+        replicas = current_app.extensions.get('replicas')
+        g.db_replica = replicas.connect() if replicas else None
+    return g.db_replica
+
+
+def release_replica(exception=None):
+    connection = g.pop('db_replica', None)
+    if connection is not None:
+        db.session.remove()
+        connection.close()
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            # Later reads in this request must see the write.
+            if has_request_context():
+                g.db_primary = True
+        else:
+            replica = replica_connection()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+'''
+Connection pool settings
+Each can be passed to setup_db or set through its environment variable.
+'''
+POOL_SETTINGS = {
+    'pool_size': ('DB_POOL_SIZE', int, 5),
+    'max_overflow': ('DB_MAX_OVERFLOW', int, 10),
+    'pool_timeout': ('DB_POOL_TIMEOUT', int, 30),
+    'pool_recycle': ('DB_POOL_RECYCLE', int, 1800),
+    'pool_pre_ping': ('DB_POOL_PRE_PING',
+                      lambda value: value.lower() in ('1', 'true'), True),
+}
+
+
+def engine_options(database_path, external_pooler=None, **overrides):
+    settings = {}
+    for name, (env_name, parse, default) in POOL_SETTINGS.items():
+        if overrides.get(name) is not None:
+            settings[name] = overrides[name]
+        elif env_name in os.environ:
+            settings[name] = parse(os.environ[env_name])
+        else:
+            settings[name] = default
+
+    if external_pooler is None:
+        external_pooler = os.environ.get(
+            'DB_EXTERNAL_POOLER', '').lower() in ('1', 'true')
+
+    options = {'pool_pre_ping': settings['pool_pre_ping']}
+    if external_pooler:
+        # pgbouncer (or similar) owns the connections; hold none ourselves.
+        options['poolclass'] = NullPool
+    elif not database_path.startswith('sqlite'):
+        options.update(
+            pool_size=settings['pool_size'],
+            max_overflow=settings['max_overflow'],
+            pool_timeout=settings['pool_timeout'],
+            pool_recycle=settings['pool_recycle'])
+    return options
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, external_pooler=None,
+             replica_urls=None, **pool_settings):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, external_pooler, **pool_settings)
     db.app = app
     db.init_app(app)
+
+    if replica_urls is None:
+        replica_urls = [url.strip() for url in os.environ.get(
+            'DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    if replica_urls:
+        app.extensions['replicas'] = ReplicaSet(
+            [create_engine(url, **engine_options(url, external_pooler,
+                                                 **pool_settings))
+             for url in replica_urls],
+            retry_interval=int(os.environ.get('REPLICA_RETRY_INTERVAL', 30)))
+        # Registered after Flask-SQLAlchemy's teardown, so it runs first.
+        app.teardown_appcontext(release_replica)
+
+
+def create_tables():
+    '''
+    Creates any missing tables and the version row of every menu table.
+    Startup never issues DDL; this runs from `python manage.py create_db`,
+    or use `python manage.py db upgrade`.
+    '''
     db.create_all()
+    for model in MenuItem.__subclasses__():
+        if db.session.execute(version_query(model.__tablename__)).first() \
+                is None:
+            db.session.execute(TableVersion.__table__.insert().values(
+                table_name=model.__tablename__, version=0,
+                updated_at=datetime.utcnow()))
+    db.session.commit()
 
 
-class Drink(db.Model):
-    id = db.Column(Integer, primary_key=True)
-    title = db.Column(String, unique=True, nullable=False)
+'''
+Pool statistics
+Counters fed by pool events, reported on /metrics so the pool can be
+sized from real traffic.
+'''
 
-    def insert(self):
-        db.session.add(self)
-        db.session.commit()
 
-    def update(self):
-        db.session.commit()
+class PoolStats:
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self._lock = threading.Lock()
 
-    def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+    def on_connect(self, *args):
+        with self._lock:
+            self.connects += 1
 
-    def format(self):
+    def on_checkout(self, *args):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out,
+                                        self.checked_out)
+
+    def on_checkin(self, *args):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def on_invalidate(self, *args):
+        with self._lock:
+            self.invalidations += 1
+
+    def snapshot(self):
         return {
-            'id': self.id,
-            'title': self.title,
+            'connects': self.connects,
+            'checkouts': self.checkouts,
+            'checkins': self.checkins,
+            'invalidations': self.invalidations,
+            'checked_out': self.checked_out,
+            'peak_checked_out': self.peak_checked_out
         }
 
 
-class Dessert(db.Model):
+pool_stats = PoolStats()
+event.listen(Pool, 'connect', pool_stats.on_connect)
+event.listen(Pool, 'checkout', pool_stats.on_checkout)
+event.listen(Pool, 'checkin', pool_stats.on_checkin)
+event.listen(Pool, 'invalidate', pool_stats.on_invalidate)
+
+
+'''
+Table versions
+One row per menu table, bumped in the same transaction as every write to
+that table. Listings derive their ETag and Last-Modified from it, so a
+client revalidating a listing costs one primary-key lookup. Written rows
+are stamped with the new version and deleted ids are kept as tombstones,
+so clients can ask for everything that changed after a version.
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'menu_version'
+    table_name = db.Column(String, primary_key=True)
+    version = db.Column(Integer, nullable=False)
+    updated_at = db.Column(DateTime, nullable=False)
+
+
+class Tombstone(db.Model):
+    __tablename__ = 'menu_tombstone'
+    __table_args__ = (
+        db.Index('ix_menu_tombstone_version', 'table_name', 'version'),
+    )
+    id = db.Column(Integer, primary_key=True)
+    table_name = db.Column(String, nullable=False)
+    item_id = db.Column(Integer, nullable=False)
+    version = db.Column(Integer, nullable=False)
+
+
+def tombstone_rows(table_name, ids, version):
+    return [{'table_name': table_name, 'item_id': id, 'version': version}
+            for id in ids]
+
+
+def version_query(table_name):
+    table = TableVersion.__table__
+    return (select([table.c.version, table.c.updated_at])
+            .where(table.c.table_name == table_name))
+
+
+def version_bump(table_name, now):
+    table = TableVersion.__table__
+    return (table.update()
+            .where(table.c.table_name == table_name)
+            .values(version=table.c.version + 1, updated_at=now))
+
+
+def bump_version(table_name):
+    '''
+    Bumps the version of `table_name` inside the current transaction and
+    returns the new (version, updated_at) to stamp written rows with.
+    '''
+    # The UPDATE locks the version row until commit, so concurrent writers
+    # to one table each get their own version.
+    now = datetime.utcnow()
+    if db.session.execute(version_bump(table_name, now)).rowcount == 0:
+        db.session.execute(TableVersion.__table__.insert().values(
+            table_name=table_name, version=1, updated_at=now))
+        return 1, now
+    return db.session.execute(version_query(table_name)).first().version, now
+
+
+def table_version(table_name):
+    '''
+    Returns (version, updated_at) for `table_name`; (0, None) before the
+    table's first write.
+    '''
+    row = db.session.execute(version_query(table_name)).first()
+    return (row.version, row.updated_at) if row is not None else (0, None)
+
+
+def changes_since(model, since):
+    '''
+    Returns the (id, title) rows of `model` written after version `since`,
+    in id order, and the ids deleted after it. An id can appear in both
+    when SQLite reuses it; apply the deletions first.
+    '''
+    query = db.session.query(model.id, model.title).order_by(model.id)
+    if not since:
+        # Rows older than the change-tracking migration carry version 0,
+        # so a full sync reads the table unfiltered.
+        return query.all(), []
+    rows = query.filter(model.version > since).all()
+    deleted = [row.item_id for row in db.session.query(Tombstone.item_id)
+               .filter(Tombstone.table_name == model.__tablename__,
+                       Tombstone.version > since)
+               .order_by(Tombstone.version, Tombstone.item_id)]
+    return rows, list(dict.fromkeys(deleted))
+
+
+def keyset_page(model, after_id=None, limit=100):
+    '''
+    Returns up to `limit` (id, title) rows of `model` with id greater than
+    `after_id`, in id order, and the cursor for the next page (None on the
+    last page). Only the two columns are selected; no entities are built.
+    '''
+    query = db.session.query(model.id, model.title).order_by(model.id)
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def stream_rows(model, batch_size=500):
+    '''
+    Iterates every (id, title) row of `model` in id order, fetching
+    `batch_size` rows at a time through a server-side cursor instead of
+    loading the table.
+    '''
+    return (db.session.query(model.id, model.title)
+            .order_by(model.id).yield_per(batch_size))
+
+
+# How often a bulk insert that lost a race for a title is retried.
+BULK_INSERT_ATTEMPTS = 3
+
+
+def bulk_insert(model, titles):
+    '''
+    Inserts every title not already present in one executemany and one
+    commit. Returns {title: (id, created)}; titles that already existed map
+    to their current id with created=False.
+    '''
+    titles = list(dict.fromkeys(titles))
+    # A concurrent writer can claim a title between our lookup and insert;
+    # the unique constraint catches that and we retry against fresh data.
+    for attempt in range(BULK_INSERT_ATTEMPTS):
+        existing = dict(db.session.query(model.title, model.id)
+                        .filter(model.title.in_(titles)).all())
+        new_titles = [title for title in titles if title not in existing]
+        try:
+            if new_titles:
+                version, now = bump_version(model.__tablename__)
+                db.session.execute(
+                    model.__table__.insert(),
+                    [{'title': title, 'version': version, 'updated_at': now}
+                     for title in new_titles])
+            created = dict(db.session.query(model.title, model.id)
+                           .filter(model.title.in_(new_titles)).all())
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == BULK_INSERT_ATTEMPTS - 1:
+                raise
+            continue
+        if new_titles:
+            listing_cache.invalidate(model.__tablename__)
+            publish_change(model.__tablename__, 'created',
+                           sorted(created.values()), version)
+        results = {title: (id, False) for title, id in existing.items()}
+        results.update(
+            (title, (id, True)) for title, id in created.items())
+        return results
+
+
+def upsert_statement(table, title, dialect_name):
+    '''
+    One INSERT of `title` that does nothing when a row already holds the
+    title. On Postgres it returns the new row's id, and no row on a
+    conflict; elsewhere the rowcount tells the two apart. The row is
+    inserted at version 0 and stamped by upsert_stamp in the same
+    transaction.
+    '''
+    # The version is spelled out: the databases library skips Python-side
+    # column defaults, and OR IGNORE would swallow the NOT NULL violation.
+    values = {'title': title, 'version': 0}
+    if dialect_name == 'postgresql':
+        return postgresql.insert(table).values(**values) \
+            .on_conflict_do_nothing(index_elements=[table.c.title]) \
+            .returning(table.c.id)
+    # SQLAlchemy 1.3 has neither ON CONFLICT nor RETURNING for SQLite.
+    return table.insert().prefix_with('OR IGNORE').values(**values)
+
+
+def upsert_lookup(table, title):
+    return select([table.c.id]).where(table.c.title == title)
+
+
+def upsert_stamp(table, id, version, now):
+    return table.update().where(table.c.id == id) \
+        .values(version=version, updated_at=now)
+
+
+def upsert(model, title):
+    '''
+    Creates `title` unless the table already has it. Returns (id, created).
+    Finding an existing title costs the INSERT and a lookup; only a row
+    actually inserted bumps the table version.
+    '''
+    table = model.__table__
+    dialect_name = db.engine.dialect.name
+    result = db.session.execute(upsert_statement(table, title, dialect_name))
+    if dialect_name == 'postgresql':
+        row = result.first()
+        id = row.id if row is not None else None
+    else:
+        id = result.lastrowid if result.rowcount == 1 else None
+    if id is None:
+        id = db.session.execute(upsert_lookup(table, title)).scalar()
+        db.session.rollback()
+        return id, False
+    version, now = bump_version(model.__tablename__)
+    db.session.execute(upsert_stamp(table, id, version, now))
+    db.session.commit()
+    listing_cache.invalidate(model.__tablename__)
+    publish_change(model.__tablename__, 'created', [id], version)
+    return id, True
+
+
+def _affected_ids(model, statement, ids):
+    # Postgres reports the touched rows from the statement itself; other
+    # backends lock and read the matching ids first, in the same transaction.
+    if db.engine.dialect.name == 'postgresql':
+        return [row.id for row in db.session.execute(
+            statement.returning(model.__table__.c.id))]
+    found = [row.id for row in db.session.query(model.id)
+             .filter(model.id.in_(ids)).with_for_update()]
+    if found:
+        db.session.execute(statement)
+    return found
+
+
+def _bulk_write(model, ids, statement, action, tombstones=False):
+    # `statement` builds the write for the new (version, updated_at); a
+    # write that matches no rows is rolled back, version bump included.
+    try:
+        version, now = bump_version(model.__tablename__)
+        affected = _affected_ids(model, statement(version, now), ids)
+        if not affected:
+            db.session.rollback()
+            return affected
+        if tombstones:
+            db.session.execute(
+                Tombstone.__table__.insert(),
+                tombstone_rows(model.__tablename__, affected, version))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    listing_cache.invalidate(model.__tablename__)
+    publish_change(model.__tablename__, action, affected, version)
+    return affected
+
+
+def bulk_update(model, titles_by_id):
+    '''
+    Renames every row in `titles_by_id` ({id: title}) with a single
+    UPDATE ... WHERE id IN (...). Returns the ids that existed.
+    '''
+    table = model.__table__
+    ids = list(titles_by_id)
+
+    def statement(version, now):
+        return (table.update()
+                .where(table.c.id.in_(ids))
+                .values(title=case(titles_by_id, value=table.c.id),
+                        version=version, updated_at=now))
+    return _bulk_write(model, ids, statement, 'updated')
+
+
+def bulk_delete(model, ids):
+    '''
+    Deletes every row in `ids` with a single DELETE ... WHERE id IN (...).
+    Returns the ids that existed.
+    '''
+    table = model.__table__
+
+    def statement(version, now):
+        return table.delete().where(table.c.id.in_(ids))
+    return _bulk_write(model, ids, statement, 'deleted', tombstones=True)
+
+
+'''
+MenuItem
+Columns and persistence helpers shared by every menu category. Each
+category is a model mixing this into db.Model, registered in resources.py.
+'''
+
+
+class MenuItem:
     id = db.Column(Integer, primary_key=True)
     title = db.Column(String, unique=True, nullable=False)
+    version = db.Column(Integer, nullable=False, default=0,
+                        server_default='0', index=True)
+    updated_at = db.Column(DateTime)
 
     def insert(self):
+        version, self.updated_at = bump_version(self.__tablename__)
+        self.version = version
         db.session.add(self)
         db.session.commit()
+        listing_cache.invalidate(self.__tablename__)
+        publish_change(self.__tablename__, 'created', [self.id], version)
 
     def update(self):
+        version, self.updated_at = bump_version(self.__tablename__)
+        self.version = version
         db.session.commit()
+        listing_cache.invalidate(self.__tablename__)
+        publish_change(self.__tablename__, 'updated', [self.id], version)
 
     def delete(self):
+        id = self.id
+        version, _ = bump_version(self.__tablename__)
+        db.session.execute(Tombstone.__table__.insert(), tombstone_rows(
+            self.__tablename__, [id], version))
         db.session.delete(self)
         db.session.commit()
+        listing_cache.invalidate(self.__tablename__)
+        publish_change(self.__tablename__, 'deleted', [id], version)
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title
         }
+
+
+class Drink(MenuItem, db.Model):
+    pass
+
+
+class Dessert(MenuItem, db.Model):
+    pass
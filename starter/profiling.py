@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+
+from flask import g, has_request_context, jsonify, request
+from sqlalchemy import event
+
+from metrics import route_label
+from models import db
+
+'''
+SQL profiling
+Opt-in (SQL_PROFILE=1) recording of every statement a request runs, with
+its duration and the route that issued it. Statements slower than
+SQL_SLOW_QUERY_MS are flagged, as are identical statements repeated within
+one request and statements run SQL_N_PLUS_ONE_THRESHOLD or more times with
+different parameters (the N+1 pattern). When the app runs in debug mode,
+each response carries a summary header and GET /debug/sql returns the
+totals per route; otherwise the totals are only kept on the profiler,
+since statements can carry anything a request was sent.
+'''
+
+PROFILE_HEADER = 'X-SQL-Profile'
+
+
+def profiling_enabled():
+    return os.environ.get('SQL_PROFILE', '').lower() in ('1', 'true')
+
+
+def parameters_key(parameters):
+    # query.get('1') and the reload after commit bind '1' and 1; both are
+    # the same lookup, so values are compared as strings.
+    if isinstance(parameters, dict):
+        return tuple(sorted((name, str(value))
+                            for name, value in parameters.items()))
+    if isinstance(parameters, (list, tuple)):
+        return tuple(parameters_key(value)
+                     if isinstance(value, (dict, list, tuple))
+                     else str(value) for value in parameters)
+    return str(parameters)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.queries = []
+
+    def record(self, statement, parameters, seconds):
+        self.queries.append((statement, parameters_key(parameters), seconds))
+
+    def summary(self, slow_seconds, n_plus_one):
+        executions = {}
+        shapes = {}
+        for statement, parameters, seconds in self.queries:
+            key = (statement, parameters)
+            executions[key] = executions.get(key, 0) + 1
+            shapes[statement] = shapes.get(statement, 0) + 1
+        return {
+            'queries': len(self.queries),
+            'seconds': sum(seconds for _, _, seconds in self.queries),
+            'slow': [(statement, seconds)
+                     for statement, _, seconds in self.queries
+                     if seconds >= slow_seconds],
+            'repeated': sorted({statement for (statement, _), count
+                                in executions.items() if count > 1}),
+            'n_plus_one': sorted(statement for statement, count
+                                 in shapes.items() if count >= n_plus_one)
+        }
+
+
+class RouteReport:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.seconds = 0.0
+        self.slow = {}
+        self.repeated = {}
+        self.n_plus_one = {}
+
+    def add(self, summary):
+        self.requests += 1
+        self.queries += summary['queries']
+        self.max_queries = max(self.max_queries, summary['queries'])
+        self.seconds += summary['seconds']
+        for statement, seconds in summary['slow']:
+            self.slow[statement] = max(self.slow.get(statement, 0.0),
+                                       seconds)
+        for found, statements in ((self.repeated, summary['repeated']),
+                                  (self.n_plus_one, summary['n_plus_one'])):
+            for statement in statements:
+                found[statement] = found.get(statement, 0) + 1
+
+    def format(self):
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'max_queries': self.max_queries,
+            'mean_queries': round(self.queries / self.requests, 2),
+            'time_ms': round(self.seconds * 1000, 3),
+            'slow': [{'statement': statement,
+                      'max_ms': round(seconds * 1000, 3)}
+                     for statement, seconds in sorted(self.slow.items())],
+            'repeated': [{'statement': statement, 'requests': count}
+                         for statement, count
+                         in sorted(self.repeated.items())],
+            'n_plus_one': [{'statement': statement, 'requests': count}
+                           for statement, count
+                           in sorted(self.n_plus_one.items())]
+        }
+
+
+'''
+QueryProfiler
+Listens to one engine's cursor events and folds each finished request's
+statements into the per-route report.
+'''
+
+
+class QueryProfiler:
+    def __init__(self, slow_seconds=0.1, n_plus_one=5):
+        self.slow_seconds = slow_seconds
+        self.n_plus_one = n_plus_one
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('profile_started', []).append(
+            time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        seconds = time.perf_counter() - conn.info['profile_started'].pop()
+        if not has_request_context():
+            return
+        if 'sql_profile' not in g:
+            g.sql_profile = RequestProfile()
+        g.sql_profile.record(statement, parameters, seconds)
+
+    def finish_request(self, route, profile):
+        summary = profile.summary(self.slow_seconds, self.n_plus_one)
+        with self._lock:
+            report = self.routes.get(route)
+            if report is None:
+                report = self.routes[route] = RouteReport()
+            report.add(summary)
+        return summary
+
+    def report(self):
+        with self._lock:
+            return {route: report.format()
+                    for route, report in sorted(self.routes.items())}
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+
+
+def summary_header(summary):
+    return ('queries=%d; time_ms=%.3f; slow=%d; repeated=%d; '
+            'n_plus_one=%d' % (summary['queries'], summary['seconds'] * 1000,
+                               len(summary['slow']), len(summary['repeated']),
+                               len(summary['n_plus_one'])))
+
+
+def init_profiling(app, profiler=None):
+    '''
+    Attaches a profiler to the app's engine when SQL_PROFILE is set (or a
+    profiler is passed in) and returns it; returns None otherwise. The
+    header and /debug/sql are only added to an app in debug mode.
+    '''
+    if profiler is None:
+        if not profiling_enabled():
+            return None
+        profiler = QueryProfiler(
+            slow_seconds=float(os.environ.get('SQL_SLOW_QUERY_MS', 100))
+            / 1000,
+            n_plus_one=int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 5)))
+    replicas = app.extensions.get('replicas')
+    with app.app_context():
+        profiler.attach(db.get_engine(app))
+    for engine in replicas.engines if replicas else ():
+        profiler.attach(engine)
+    app.extensions['sql_profiler'] = profiler
+
+    exposed = app.debug
+
+    @app.after_request
+    def profile_request(response):
+        if exposed and request.path == '/debug/sql':
+            return response
+        summary = profiler.finish_request(
+            route_label(), g.pop('sql_profile', RequestProfile()))
+        if exposed:
+            response.headers[PROFILE_HEADER] = summary_header(summary)
+        for statement, seconds in summary['slow']:
+            app.logger.warning('slow query (%.1fms) on %s: %s',
+                               seconds * 1000, request.path, statement)
+        return response
+
+    if exposed:
+        @app.route('/debug/sql')
+        def sql_report():
+            return jsonify(profiler.report())
+
+    return profiler
@@ -0,0 +1,240 @@
+import asyncio
+import math
+import os
+import sys
+import threading
+import time
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from cache import LRUCache
+from metrics import asgi_route_label, route_label
+
+'''
+Rate limiting
+Each caller (the token's `sub`) gets a token bucket per route that
+refills at RATE_LIMIT (e.g. `20/s`, `600/m`) up to RATE_LIMIT_BURST
+requests. A request finding its bucket empty is refused with 429 and a
+Retry-After telling the caller when the next request will be accepted.
+'''
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_rate(value):
+    '''
+    Parses `<requests>/<s|m|h>` into requests per second.
+    '''
+    count, _, unit = value.partition('/')
+    if unit[:1] not in RATE_UNITS or float(count) <= 0:
+        raise ValueError('rate must look like 20/s, 600/m or 1000/h')
+    return float(count) / RATE_UNITS[unit[:1]]
+
+
+def refill(tokens, updated, rate, burst, now):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+class LocalLimiterBackend:
+    # A bucket left alone for burst / rate seconds is full again, the same
+    # as one never seen, so entries expire after that long.
+    def __init__(self, maxsize=10000, clock=time.monotonic):
+        self.buckets = LRUCache(maxsize=maxsize, clock=clock)
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        with self._lock:
+            now = self._clock()
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = refill(tokens, updated, rate, burst, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets.set(key, (tokens, now), ttl=burst / rate)
+        return allowed, tokens
+
+
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+
+class RedisLimiterBackend:
+    # Buckets shared by every worker. The refill is done in one script so
+    # concurrent requests cannot both spend the last token.
+    def __init__(self, url, prefix='capstone:ratelimit:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, key, rate, burst):
+        try:
+            allowed, tokens = self.script(keys=[self.prefix + key],
+                                          args=[rate, burst, time.time()])
+        except Exception as e:
+            # An unreachable Redis must not take the API down with it.
+            print('rate limit check failed: %s' % e, file=sys.stderr)
+            return True, burst
+        return bool(allowed), float(tokens)
+
+
+def limiter_backend_from_url(url=None):
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisLimiterBackend(url)
+    return LocalLimiterBackend()
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None, backend=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.backend = backend or LocalLimiterBackend()
+        self.limited = 0
+
+    def check(self, subject, route):
+        allowed, tokens = self.backend.take(
+            '%s:%s' % (subject, route), self.rate, self.burst)
+        if not allowed:
+            self.limited += 1
+            raise TooManyRequests(
+                retry_after=max(1, math.ceil((1 - tokens) / self.rate)))
+
+
+def check_caller(limiter, payload, address, method, route):
+    if limiter is not None:
+        limiter.check(payload.get('sub', address), '%s %s' % (method, route))
+
+
+def check_rate_limit(payload):
+    check_caller(current_app.extensions.get('rate_limiter'), payload,
+                 request.remote_addr, request.method, route_label())
+
+
+async def check_rate_limit_async(request, payload):
+    # The async app keeps its limiter on the Starlette app's state.
+    limiter = getattr(request.app.state, 'rate_limiter', None)
+    if limiter is None:
+        return
+    args = (limiter, payload, request.client.host if request.client else None,
+            request.method, asgi_route_label(request))
+    if isinstance(limiter.backend, LocalLimiterBackend):
+        check_caller(*args)
+    else:
+        # A shared backend is a network round trip; keep it off the loop.
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, check_caller, *args)
+
+
+def retry_after_headers(error):
+    retry_after = getattr(error, 'retry_after', None)
+    return {'Retry-After': str(retry_after)} if retry_after else {}
+
+
+'''
+AdmissionControl
+Caps the requests one worker process handles at once. The default cap is
+the database pool's capacity (DB_POOL_SIZE + DB_MAX_OVERFLOW), so excess
+requests are refused with 503 straight away instead of queueing for
+DB_POOL_TIMEOUT seconds on a connection. Long-lived event streams and
+/metrics are not counted.
+'''
+
+ADMISSION_EXEMPT_PATHS = frozenset(['/metrics', '/menu/events'])
+
+
+class AdmissionControl:
+    def __init__(self, limit, retry_after=1):
+        self.limit = limit
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def default_concurrency_limit():
+    return (int(os.environ.get('DB_POOL_SIZE', 5)) +
+            int(os.environ.get('DB_MAX_OVERFLOW', 10)))
+
+
+def rate_limiter_from_env():
+    '''
+    The limiter configured by RATE_LIMIT, or None when it is unset.
+    '''
+    if not os.environ.get('RATE_LIMIT'):
+        return None
+    rate = parse_rate(os.environ['RATE_LIMIT'])
+    burst = os.environ.get('RATE_LIMIT_BURST')
+    return RateLimiter(
+        rate, float(burst) if burst else None,
+        limiter_backend_from_url(os.environ.get('RATE_LIMIT_URL')))
+
+
+def admission_from_env(default_limit=None):
+    '''
+    The concurrency cap configured by MAX_CONCURRENT_REQUESTS (by default
+    `default_limit`, else the pool capacity), or None when it is 0.
+    '''
+    if default_limit is None:
+        default_limit = default_concurrency_limit()
+    limit = int(os.environ.get('MAX_CONCURRENT_REQUESTS', default_limit))
+    return AdmissionControl(limit) if limit > 0 else None
+
+
+def init_rate_limiting(app, limiter=None, admission=None):
+    '''
+    Enables per-caller rate limiting when RATE_LIMIT is set and the
+    concurrency cap unless MAX_CONCURRENT_REQUESTS is 0.
+    '''
+    if limiter is None:
+        limiter = rate_limiter_from_env()
+    if limiter is not None:
+        app.extensions['rate_limiter'] = limiter
+
+    if admission is None:
+        admission = admission_from_env()
+        if admission is None:
+            return
+    app.extensions['admission'] = admission
+
+    @app.before_request
+    def admit_request():
+        if request.path in ADMISSION_EXEMPT_PATHS:
+            return
+        if not admission.admit():
+            raise ServiceUnavailable(retry_after=admission.retry_after)
+        g.admitted = True
+
+    @app.teardown_request
+    def release_request(exc):
+        if g.pop('admitted', False):
+            admission.release()
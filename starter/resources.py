@@ -0,0 +1,519 @@
+import hashlib
+from datetime import datetime
+from os import environ as env
+
+from flask import (Blueprint, Response, abort, current_app, request,
+                   stream_with_context)
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import is_resource_modified, parse_accept_header
+
+import constants
+from auth import granted_permissions, requires_auth
+from cache import listing_cache
+from events import (EVENT_HEARTBEAT, HEARTBEAT, RESET, RETRY, Subscriber,
+                    broker, format_event)
+from idempotency import idempotent
+from metrics import timed
+from models import (Dessert, Drink, bulk_delete, bulk_insert, bulk_update,
+                    changes_since, keyset_page, stream_rows, table_version,
+                    upsert)
+from ratelimit import AdmissionControl
+from search import search_titles
+from serializers import dumps, dumps_compact
+
+MAX_PAGE_SIZE = int(env.get(constants.MAX_PAGE_SIZE, 100))
+MAX_BULK_SIZE = int(env.get(constants.MAX_BULK_SIZE, 1000))
+# A sync worker is held by an event subscriber for as long as it stays
+# connected, so sync workers (the Procfile default) take none; serve
+# /menu/events from the async app instead.
+MAX_EVENT_SUBSCRIBERS = int(env.get(
+    constants.MAX_EVENT_SUBSCRIBERS,
+    0 if env.get('WORKER_CLASS', 'sync') in ('sync', 'gthread') else 1000))
+EVENT_SUBSCRIBER_RETRY_AFTER = 30
+
+
+def json_response(body):
+    with timed('serialize'):
+        return Response(dumps(body), mimetype='application/json')
+
+
+def get_page_args():
+    return parse_page_args(request.args)
+
+
+def parse_page_args(args):
+    # Listings default to one maximum-size page, so small tables come back
+    # whole and in the original response shape.
+    try:
+        limit = int(args.get('limit', MAX_PAGE_SIZE))
+        cursor = args.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), cursor
+
+
+def parse_search_args(args):
+    # For search results the cursor is an offset into the ranking.
+    limit, offset = parse_page_args(args)
+    offset = offset or 0
+    if offset < 0:
+        abort(400)
+    return limit, offset
+
+
+def parse_since(args):
+    try:
+        since = int(args.get('since', 0))
+    except ValueError:
+        abort(400)
+    if since < 0:
+        abort(400)
+    return since
+
+
+def changes_body(key, rows, deleted, version):
+    return {
+        'success': True,
+        key: [{'id': id, 'title': title} for id, title in rows],
+        'deleted': deleted,
+        'version': version
+    }
+
+
+def page_body(key, items, next_cursor):
+    body = {
+        'success': True,
+        key: items
+    }
+    if next_cursor is not None:
+        body['next_cursor'] = str(next_cursor)
+    return body
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_CHUNK_ROWS = 100
+
+
+def prefers_ndjson(accept):
+    # Takes the raw Accept header so the async app negotiates the same way.
+    return parse_accept_header(accept, MIMEAccept).best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return prefers_ndjson(request.headers.get('Accept'))
+
+
+def stream_listing(key, rows):
+    # Emits the whole table without materializing it. NDJSON clients get
+    # one item per line; everyone else gets the usual listing document.
+    ndjson = prefers_ndjson(request.headers.get('Accept'))
+
+    def generate():
+        if not ndjson:
+            yield b'{"%s":[' % key.encode('utf-8')
+        chunk = []
+        separator = b'\n' if ndjson else b','
+        first = True
+        for id, title in rows:
+            chunk.append(dumps_compact({'id': id, 'title': title}))
+            if len(chunk) == STREAM_CHUNK_ROWS:
+                yield (b'' if first else separator) + separator.join(chunk)
+                chunk = []
+                first = False
+        if chunk:
+            yield (b'' if first else separator) + separator.join(chunk)
+            first = False
+        if ndjson:
+            if not first:
+                yield b'\n'
+        else:
+            yield b'],"success":true}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype=NDJSON_MIMETYPE if ndjson else 'application/json')
+
+
+def version_tag(version, updated_at):
+    # The timestamp tells a recreated table apart from its earlier life at
+    # the same version number.
+    stamp = updated_at.isoformat() if updated_at is not None else ''
+    return '%d@%s' % (version, stamp)
+
+
+def listing_etag(table_name, tag, resource):
+    return hashlib.sha1(('%s:%s:%s' % (table_name, tag, resource))
+                        .encode('utf-8')).hexdigest()
+
+
+def settled_last_modified(updated_at):
+    '''
+    Returns `updated_at` once the second it falls in is over, else None.
+    HTTP dates stop at whole seconds, so a Last-Modified sent while more
+    writes can land in the same second would let a client polling with
+    If-Modified-Since get 304 for rows it has never seen.
+    '''
+    if updated_at is None:
+        return None
+    if updated_at.replace(microsecond=0) >= \
+            datetime.utcnow().replace(microsecond=0):
+        return None
+    return updated_at
+
+
+def cached_listing(model, build):
+    # Answers If-None-Match / If-Modified-Since from the table's version
+    # row alone. Otherwise serves the listing from the response cache,
+    # keyed by that version, building and storing it on a miss.
+    table_name = model.__tablename__
+    version, updated_at = table_version(table_name)
+    tag = version_tag(version, updated_at)
+    resource = '%s?%s' % (request.path,
+                          request.query_string.decode('utf-8'))
+    etag = listing_etag(table_name, tag, resource)
+    last_modified = settled_last_modified(updated_at)
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        cache_key = listing_cache.key_for(
+            table_name, '%s:%s' % (tag, resource))
+        entry = listing_cache.get(cache_key)
+        if entry is None:
+            entry = {'body': build().get_data(as_text=True)}
+            listing_cache.set(cache_key, entry)
+        response = Response(entry['body'], mimetype='application/json')
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def wants_upsert(args):
+    return args.get('upsert') in ('1', 'true')
+
+
+def parse_upsert_title(body):
+    title = body.get('title') if isinstance(body, dict) else None
+    if not isinstance(title, str) or not title:
+        abort(400)
+    return title
+
+
+def upsert_body(key, id, title, created):
+    return {
+        'success': True,
+        key: [{'id': id, 'title': title}],
+        'created': created
+    }
+
+
+def get_bulk_titles():
+    return parse_bulk_titles(request.get_json())
+
+
+def parse_bulk_titles(body):
+    if not isinstance(body, dict) or not isinstance(body.get('titles'), list):
+        abort(400)
+    titles = body['titles']
+    if not titles or len(titles) > MAX_BULK_SIZE:
+        abort(400)
+    return titles
+
+
+def bulk_create(model, key, titles):
+    valid = [title for title in titles if isinstance(title, str) and title]
+    created, results = bulk_results(titles, bulk_insert(model, valid))
+    return json_response({
+        'success': True,
+        key: created,
+        'results': results
+    })
+
+
+def bulk_results(titles, inserted):
+    # Reports every requested title, in request order, against the
+    # {title: (id, created)} map returned by the bulk insert.
+    results = []
+    created = []
+    seen = set()
+    for title in titles:
+        if not isinstance(title, str) or title not in inserted:
+            results.append({'title': title, 'id': None, 'status': 'invalid'})
+            continue
+        id, is_new = inserted[title]
+        if is_new and title not in seen:
+            created.append({'id': id, 'title': title})
+            status = 'created'
+        else:
+            status = 'duplicate'
+        seen.add(title)
+        results.append({'title': title, 'id': id, 'status': status})
+    return created, results
+
+
+def get_bulk_ids():
+    return parse_bulk_ids(request.get_json())
+
+
+def parse_bulk_ids(body):
+    if not isinstance(body, dict) or not isinstance(body.get('ids'), list):
+        abort(400)
+    ids = body['ids']
+    if not ids or len(ids) > MAX_BULK_SIZE:
+        abort(400)
+    if not all(isinstance(id, int) and not isinstance(id, bool)
+               for id in ids):
+        abort(400)
+    return list(dict.fromkeys(ids))
+
+
+def get_bulk_renames():
+    return parse_bulk_renames(request.get_json())
+
+
+def parse_bulk_renames(body):
+    if not isinstance(body, dict) or not isinstance(body.get('items'), list):
+        abort(400)
+    items = body['items']
+    if not items or len(items) > MAX_BULK_SIZE:
+        abort(400)
+    titles_by_id = {}
+    for item in items:
+        if not isinstance(item, dict):
+            abort(400)
+        id = item.get('id')
+        title = item.get('title')
+        if not isinstance(id, int) or isinstance(id, bool):
+            abort(400)
+        if not isinstance(title, str) or not title:
+            abort(400)
+        titles_by_id[id] = title
+    return titles_by_id
+
+
+def bulk_patch(model, key, titles_by_id):
+    try:
+        updated = bulk_update(model, titles_by_id)
+    except Exception:
+        current_app.logger.exception('bulk update of %s failed', key)
+        abort(422)
+    found = set(updated)
+    return json_response({
+        'success': True,
+        key: [{'id': id, 'title': titles_by_id[id]} for id in updated],
+        'missing': [id for id in titles_by_id if id not in found]
+    })
+
+
+def bulk_remove(model, ids):
+    try:
+        deleted = bulk_delete(model, ids)
+    except Exception:
+        current_app.logger.exception('bulk delete of %s failed',
+                                     model.__tablename__)
+        abort(422)
+    found = set(deleted)
+    return json_response({
+        'success': True,
+        'delete': deleted,
+        'missing': [id for id in ids if id not in found]
+    })
+
+
+'''
+MenuResource
+One menu category exposed over HTTP. The category name is the URL prefix,
+the key items are listed under in responses, and the suffix of the
+permissions that guard it (get:<name>, post:<name>, ...).
+'''
+
+
+class MenuResource:
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+
+    def list_items(self, jwt):
+        q = request.args.get('q', '').strip()
+        if q:
+            return self.search_items(q)
+        if wants_stream():
+            return stream_listing(self.name, stream_rows(self.model))
+        limit, cursor = get_page_args()
+
+        def build():
+            rows, next_cursor = keyset_page(self.model, cursor, limit)
+            return json_response(page_body(
+                self.name, [{'id': id, 'title': title} for id, title in rows],
+                next_cursor))
+        return cached_listing(self.model, build)
+
+    def search_items(self, q):
+        limit, offset = parse_search_args(request.args)
+
+        def build():
+            matches, next_offset = search_titles(self.model, q, limit, offset)
+            return json_response(page_body(
+                self.name, [{'id': id, 'title': title}
+                            for id, title in matches], next_offset))
+        return cached_listing(self.model, build)
+
+    def list_changes(self, jwt):
+        # Rows written and ids deleted after the client's version, plus the
+        # version to send as `since` next time.
+        since = parse_since(request.args)
+
+        def build():
+            version, _ = table_version(self.model.__tablename__)
+            rows, deleted = changes_since(self.model, since)
+            return json_response(
+                changes_body(self.name, rows, deleted, version))
+        return cached_listing(self.model, build)
+
+    def create_item(self, jwt):
+        body = request.get_json()
+        if body is None:
+            abort(400)
+        if wants_upsert(request.args):
+            return self.upsert_item(parse_upsert_title(body))
+        item = self.model(title=body.get('title'))
+        item.insert()
+        return json_response({
+            'success': True,
+            self.name: [item.format()]
+        })
+
+    def upsert_item(self, title):
+        # Returns the existing item instead of failing on a taken title.
+        id, created = upsert(self.model, title)
+        return json_response(upsert_body(self.name, id, title, created))
+
+    def create_items(self, jwt):
+        return bulk_create(self.model, self.name, get_bulk_titles())
+
+    def update_items(self, jwt):
+        return bulk_patch(self.model, self.name, get_bulk_renames())
+
+    def delete_items(self, jwt):
+        return bulk_remove(self.model, get_bulk_ids())
+
+    def update_item(self, jwt, id):
+        item = self.model.query.get(id)
+        if item:
+            try:
+                body = request.get_json()
+                new_title = body.get('title')
+                if new_title:
+                    item.title = new_title
+                item.update()
+                return json_response({
+                    'success': True,
+                    self.name: [item.format()]
+                })
+            except Exception:
+                current_app.logger.exception('update of %s %s failed',
+                                             self.name, id)
+                abort(422)
+        else:
+            abort(404)
+
+    def delete_item(self, jwt, id):
+        item = self.model.query.get(id)
+        if item:
+            try:
+                item.delete()
+                return json_response({
+                    'success': True,
+                    'delete': id
+                })
+            except Exception:
+                abort(422)
+        else:
+            abort(404)
+
+    def blueprint(self):
+        routes = [
+            ('', 'list', 'GET', 'get', self.list_items),
+            ('/changes', 'changes', 'GET', 'get', self.list_changes),
+            ('', 'create', 'POST', 'post', idempotent(self.create_item)),
+            ('/bulk', 'create_bulk', 'POST', 'post',
+             idempotent(self.create_items)),
+            ('/bulk', 'update_bulk', 'PATCH', 'patch', self.update_items),
+            ('/bulk', 'delete_bulk', 'DELETE', 'delete', self.delete_items),
+            ('/<id>', 'update', 'PATCH', 'patch', self.update_item),
+            ('/<id>', 'delete', 'DELETE', 'delete', self.delete_item),
+        ]
+        blueprint = Blueprint(self.name, __name__,
+                              url_prefix='/' + self.name)
+        for rule, endpoint, method, action, handler in routes:
+            view = requires_auth('%s:%s' % (action, self.name))(handler)
+            blueprint.add_url_rule(rule, endpoint, view, methods=[method])
+        return blueprint
+
+
+# Adding a category takes a model using MenuItem and one entry here.
+MENU_RESOURCES = [
+    MenuResource(Drink, 'drinks'),
+    MenuResource(Dessert, 'desserts'),
+]
+
+
+def readable_tables(payload, resources=MENU_RESOURCES):
+    granted = granted_permissions(payload) or frozenset()
+    return [resource.model.__tablename__ for resource in resources
+            if 'get:%s' % resource.name in granted]
+
+
+def stream_events(subscriber):
+    # Blocks a worker thread per subscriber; the ASGI app serves the same
+    # stream from a coroutine instead.
+    def generate():
+        yield RETRY
+        while True:
+            events, overflowed = subscriber.wait(EVENT_HEARTBEAT)
+            if overflowed:
+                yield RESET
+            if events:
+                yield b''.join(format_event(event) for event in events)
+            elif not overflowed:
+                yield HEARTBEAT
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # Runs even when the body is never read (HEAD), where a finally
+    # block in generate() would not.
+    response.call_on_close(lambda: broker.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def register_menu_resources(app, resources=MENU_RESOURCES):
+    for resource in resources:
+        app.register_blueprint(resource.blueprint())
+    app.extensions['event_subscribers'] = AdmissionControl(
+        MAX_EVENT_SUBSCRIBERS, retry_after=EVENT_SUBSCRIBER_RETRY_AFTER)
+
+    # Subscribers need get:<name> for at least one category and only
+    # receive events for the categories they may read.
+    @requires_auth(*['get:%s' % resource.name for resource in resources],
+                   any_of=True)
+    def menu_events(jwt):
+        # Streams are exempt from the request concurrency cap and have
+        # their own, since each one holds its worker thread until the
+        # client leaves.
+        subscribers = current_app.extensions['event_subscribers']
+        if not subscribers.admit():
+            raise ServiceUnavailable(retry_after=subscribers.retry_after)
+        subscriber = Subscriber(readable_tables(jwt, resources))
+        response = stream_events(broker.subscribe(subscriber))
+        response.call_on_close(subscribers.release)
+        return response
+    app.add_url_rule('/menu/events', 'menu_events', menu_events)
@@ -0,0 +1,133 @@
+import bisect
+import threading
+
+from sqlalchemy import func
+
+from models import db, table_version
+
+'''
+Title search
+Matches are case-insensitive substrings of the title, ranked by where the
+match starts (prefix matches first), then by title length, then by id.
+Postgres answers from a pg_trgm GIN index on title; other backends (the
+SQLite test setup) use an in-process trigram index per table.
+'''
+
+
+def escape_like(value):
+    return (value.replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_titles(model, q, limit, offset=0):
+    '''
+    Returns up to `limit` (id, title) matches for `q` starting at `offset`,
+    and the offset of the next page (None on the last page).
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        rows = _search_postgres(model, q, limit + 1, offset)
+    else:
+        rows = title_index(model).search(q)[offset:offset + limit + 1]
+    if len(rows) > limit:
+        return rows[:limit], offset + limit
+    return rows, None
+
+
+def _search_postgres(model, q, limit, offset):
+    return (db.session.query(model.id, model.title)
+            .filter(title_matches(model.__table__, q))
+            .order_by(*title_ranking(model.__table__, q))
+            .limit(limit)
+            .offset(offset)
+            .all())
+
+
+def title_matches(table, q):
+    return table.c.title.ilike('%' + escape_like(q) + '%', escape='\\')
+
+
+def title_ranking(table, q):
+    position = func.strpos(func.lower(table.c.title), q.lower())
+    return position, func.length(table.c.title), table.c.id
+
+
+def create_search_indexes(bind, models):
+    if bind.dialect.name != 'postgresql':
+        return
+    bind.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for model in models:
+        table = model.__tablename__
+        bind.execute(
+            'CREATE INDEX IF NOT EXISTS ix_%s_title_trgm ON %s '
+            'USING gin (title gin_trgm_ops)' % (table, table))
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class TitleIndex:
+    def __init__(self, rows):
+        self.entries = sorted((title.lower(), id, title) for id, title in rows)
+        self.keys = [entry[0] for entry in self.entries]
+        self.postings = {}
+        for position, entry in enumerate(self.entries):
+            for gram in trigrams(entry[0]):
+                self.postings.setdefault(gram, set()).add(position)
+
+    def candidates(self, q):
+        grams = trigrams(q)
+        if not grams:
+            return range(len(self.entries))
+        postings = sorted((self.postings.get(gram, set()) for gram in grams),
+                          key=len)
+        return set.intersection(*postings)
+
+    def prefixed(self, q):
+        start = bisect.bisect_left(self.keys, q)
+        end = bisect.bisect_left(self.keys, q + '\uffff')
+        return self.entries[start:end]
+
+    def search(self, q):
+        q = q.lower()
+        matches = [(0, len(title), id, title)
+                   for _, id, title in self.prefixed(q)]
+        for position in self.candidates(q):
+            lower, id, title = self.entries[position]
+            at = lower.find(q)
+            if at > 0:
+                matches.append((at, len(title), id, title))
+        matches.sort()
+        return [(id, title) for _, _, id, title in matches]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def title_index(model):
+    # Rebuilt whenever the table's version moves, i.e. after a write.
+    table = model.__tablename__
+    version, _ = table_version(table)
+    index = current_index(table, version)
+    if index is None:
+        with _indexes_lock:
+            index = current_index(table, version)
+            if index is None:
+                rows = db.session.query(model.id, model.title).all()
+                index = store_index(table, version, rows)
+    return index
+
+
+def current_index(table, version):
+    cached = _indexes.get(table)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    return None
+
+
+def store_index(table, version, rows):
+    index = TitleIndex(rows)
+    _indexes[table] = (version, index)
+    return index
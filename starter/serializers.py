@@ -0,0 +1,45 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON serialization
+Response bodies are encoded with orjson when it is installed and with the
+standard library otherwise. Both produce what Flask's jsonify does outside
+debug mode: sorted keys, no whitespace, non-ASCII escaped and a trailing
+newline. Set JSON_SERIALIZER=json to force the standard library.
+'''
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    try:
+        body = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        return stdlib_dumps(obj)
+    # orjson writes UTF-8 where jsonify writes \u escapes; those bodies
+    # (rare for menu titles) go through the standard library instead.
+    if body.isascii():
+        return body
+    return stdlib_dumps(obj)
+
+
+SERIALIZERS = {'json': stdlib_dumps}
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson_dumps
+
+JSON_SERIALIZER = os.environ.get(
+    'JSON_SERIALIZER', 'orjson' if orjson is not None else 'json')
+dumps_compact = SERIALIZERS.get(JSON_SERIALIZER, stdlib_dumps)
+
+
+def dumps(obj):
+    return dumps_compact(obj) + b'\n'
@@ -1,11 +1,19 @@
+import gzip
 import json
 import os
 import unittest
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
 
-from flask_sqlalchemy import SQLAlchemy
+from werkzeug.http import http_date
 
 from app import create_app
-from models import Dessert, Drink, setup_db
+from events import broker
+from models import Dessert, Drink, create_tables, db
+from profiling import QueryProfiler, init_profiling
+from ratelimit import AdmissionControl, RateLimiter
 
 
 database_path = os.environ['DATABASE_URL']
@@ -16,13 +24,19 @@ barista_token = os.environ['BARISTA_TOKEN']
 class CapstoneTestCase(unittest.TestCase):
     """This class represents the capstone test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Create the schema once for the whole test case"""
+        app = create_app()
+        with app.app_context():
+            create_tables()
+
     def setUp(self):
         """Define test variables and initialize app"""
         self.app = create_app()
         self.client = self.app.test_client
         self.database_name = "capstone_test"
         self.database_path = database_path
-        setup_db(self.app, self.database_path)
 
         self.new_drink = {
             "title": "new drink"
@@ -46,17 +60,32 @@ class CapstoneTestCase(unittest.TestCase):
         self.barista_token = {
             "Authorization": "bearer {}".format(barista_token)}
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
     def tearDown(self):
         """Executed after reach test"""
         pass
 
+    def create_items(self, name, count):
+        prefix = uuid.uuid4().hex
+        res = self.client().post('/%s/bulk' % name, json={
+            'titles': ['%s %d' % (prefix, i) for i in range(count)]},
+            headers=self.manager_token)
+        return prefix, json.loads(res.data)[name]
+
+    @contextmanager
+    def clock(self, now):
+        # Stands in for datetime.utcnow where versions are stamped and
+        # where Last-Modified is decided; move it with utcnow.return_value.
+        clock = mock.Mock()
+        clock.utcnow.return_value = now
+        with mock.patch('models.datetime', clock), \
+                mock.patch('resources.datetime', clock):
+            yield clock
+
+    def search(self, name, q):
+        res = self.client().get('/%s?q=%s' % (name, q),
+                                headers=self.barista_token)
+        return json.loads(res.data)[name]
+
     def test_post_new_drink(self):
         """Test post new drink"""
         res = self.client().post('/drinks', json=self.new_drink,
@@ -75,6 +104,104 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    def test_post_new_drink_idempotent(self):
+        """Test post new drink retried with an idempotency key"""
+        headers = dict(self.manager_token,
+                       **{'Idempotency-Key': uuid.uuid4().hex})
+        drink = {'title': 'drink ' + uuid.uuid4().hex}
+        res = self.client().post('/drinks', json=drink, headers=headers)
+        retry = self.client().post('/drinks', json=drink, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(retry.data), json.loads(res.data))
+
+    def test_422_post_new_drink_idempotency_key_reused(self):
+        """Test 422 post new drink reusing an idempotency key"""
+        headers = dict(self.manager_token,
+                       **{'Idempotency-Key': uuid.uuid4().hex})
+        self.client().post('/drinks', json={
+            'title': 'drink ' + uuid.uuid4().hex}, headers=headers)
+        res = self.client().post('/drinks', json={
+            'title': 'drink ' + uuid.uuid4().hex}, headers=headers)
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_upsert_drink_idempotency_key_reused(self):
+        """Test 422 upsert drink reusing a create's idempotency key"""
+        headers = dict(self.manager_token,
+                       **{'Idempotency-Key': uuid.uuid4().hex})
+        drink = {'title': 'drink ' + uuid.uuid4().hex}
+        self.client().post('/drinks', json=drink, headers=headers)
+        res = self.client().post('/drinks?upsert=1', json=drink,
+                                 headers=headers)
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_upsert_drink(self):
+        """Test upsert drink returns the existing item"""
+        drink = {'title': 'drink ' + uuid.uuid4().hex}
+        res = self.client().post('/drinks?upsert=1', json=drink,
+                                 headers=self.manager_token)
+        again = self.client().post('/drinks?upsert=1', json=drink,
+                                   headers=self.manager_token)
+        data = json.loads(res.data)
+        data_again = json.loads(again.data)
+
+        self.assertEqual(again.status_code, 200)
+        self.assertTrue(data['created'])
+        self.assertFalse(data_again['created'])
+        self.assertEqual(data_again['drinks'], data['drinks'])
+
+    def test_upsert_drink_existing_keeps_version(self):
+        """Test upsert drink of an existing title leaves the version alone"""
+        drink = {'title': 'drink ' + uuid.uuid4().hex}
+        created = self.client().post('/drinks?upsert=1', json=drink,
+                                     headers=self.manager_token)
+        version = json.loads(self.client().get(
+            '/drinks/changes', headers=self.barista_token).data)['version']
+        with mock.patch('models.bump_version') as bump_version:
+            again = self.client().post('/drinks?upsert=1', json=drink,
+                                       headers=self.manager_token)
+        res = self.client().get('/drinks/changes',
+                                headers=self.barista_token)
+
+        self.assertTrue(json.loads(created.data)['created'])
+        self.assertFalse(json.loads(again.data)['created'])
+        self.assertEqual(json.loads(res.data)['version'], version)
+        bump_version.assert_not_called()
+
+    def test_400_upsert_drink_without_title(self):
+        """Test 400 upsert drink without a title"""
+        res = self.client().post('/drinks?upsert=1', json={},
+                                 headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_post_drinks_bulk(self):
+        """Test bulk post drinks"""
+        res = self.client().post('/drinks/bulk',
+                                 json={'titles': ['bulk drink', 'bulk drink']},
+                                 headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(data['results'][1]['status'], 'duplicate')
+
+    def test_400_post_desserts_bulk(self):
+        """Test 400 bulk post desserts without titles"""
+        res = self.client().post('/desserts/bulk', json={'titles': []},
+                                 headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
     def test_get_drinks_with_manager_token(self):
         """Test get drinks with manager token"""
         res = self.client().get('/drinks', headers=self.manager_token)
@@ -107,6 +234,160 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    def test_get_drinks_paginated(self):
+        """Test get drinks pages through every row once"""
+        _, drinks = self.create_items('drinks', 6)
+        # The new rows are the last ones, so a walk starting just before
+        # them sees exactly these, ending on a full page.
+        cursor = str(drinks[0]['id'] - 1)
+        pages = []
+        while cursor is not None:
+            res = self.client().get('/drinks?limit=3&cursor=' + cursor,
+                                    headers=self.barista_token)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            pages.append([drink['id'] for drink in data['drinks']])
+            cursor = data.get('next_cursor')
+
+        self.assertEqual(pages, [[drink['id'] for drink in drinks[:3]],
+                                 [drink['id'] for drink in drinks[3:]]])
+        self.assertNotIn('next_cursor', data)
+
+    def test_search_desserts(self):
+        """Test search desserts by title"""
+        res = self.client().get('/desserts?q=new',
+                                headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        for dessert in data['desserts']:
+            self.assertIn('new', dessert['title'].lower())
+
+    def test_304_get_drinks_not_modified(self):
+        """Test get drinks with a matching ETag"""
+        res = self.client().get('/drinks', headers=self.barista_token)
+        etag = res.headers['ETag']
+        headers = dict(self.barista_token, **{'If-None-Match': etag})
+        res = self.client().get('/drinks', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_304_get_desserts_not_modified_since(self):
+        """Test get desserts with If-Modified-Since"""
+        with self.clock(datetime.utcnow() + timedelta(seconds=2)):
+            res = self.client().get('/desserts', headers=self.barista_token)
+            last_modified = res.headers['Last-Modified']
+            headers = dict(self.barista_token,
+                           **{'If-Modified-Since': last_modified})
+            res = self.client().get('/desserts', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_get_drinks_modified_within_the_second(self):
+        """Test get drinks If-Modified-Since after a write that second"""
+        start = (datetime.utcnow() - timedelta(seconds=5)).replace(
+            microsecond=100000)
+        with self.clock(start) as clock:
+            self.client().post('/drinks',
+                               json={'title': 'drink ' + uuid.uuid4().hex},
+                               headers=self.manager_token)
+            clock.utcnow.return_value = start + timedelta(milliseconds=300)
+            first = self.client().get('/drinks', headers=self.barista_token)
+            clock.utcnow.return_value = start + timedelta(milliseconds=500)
+            self.client().post('/drinks',
+                               json={'title': 'drink ' + uuid.uuid4().hex},
+                               headers=self.manager_token)
+            headers = dict(self.barista_token,
+                           **{'If-Modified-Since': http_date(start)})
+            second = self.client().get('/drinks', headers=headers)
+            clock.utcnow.return_value = start + timedelta(seconds=1)
+            settled = self.client().get('/drinks', headers=self.barista_token)
+            headers = dict(self.barista_token, **{
+                'If-Modified-Since': settled.headers['Last-Modified']})
+            third = self.client().get('/drinks', headers=headers)
+
+        self.assertNotIn('Last-Modified', first.headers)
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(settled.headers['Last-Modified'], http_date(start))
+        self.assertEqual(third.status_code, 304)
+
+    def test_get_drinks_changes(self):
+        """Test get drinks changed since a version"""
+        res = self.client().get('/drinks/changes',
+                                headers=self.barista_token)
+        version = json.loads(res.data)['version']
+        title = 'drink ' + uuid.uuid4().hex
+        self.client().post('/drinks', json={'title': title},
+                           headers=self.manager_token)
+        res = self.client().get('/drinks/changes?since=%d' % version,
+                                headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([drink['title'] for drink in data['drinks']],
+                         [title])
+        self.assertGreater(data['version'], version)
+
+    def test_get_drinks_changes_full_sync(self):
+        """Test get drinks changes since 0 includes unversioned rows"""
+        title = 'drink ' + uuid.uuid4().hex
+        with self.app.app_context():
+            db.session.execute(Drink.__table__.insert().values(
+                title=title, version=0))
+            db.session.commit()
+        res = self.client().get('/drinks/changes?since=0',
+                                headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(title, [drink['title'] for drink in data['drinks']])
+
+    def test_get_drinks_stream(self):
+        """Test get drinks as a streamed export"""
+        res = self.client().get('/drinks?stream=1',
+                                headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertNotIn('next_cursor', data)
+
+    def test_get_drinks_ndjson(self):
+        """Test get drinks as NDJSON only when it is preferred"""
+        ndjson = dict(self.barista_token, Accept='application/x-ndjson')
+        refused = dict(self.barista_token, Accept='application/json, '
+                       'application/x-ndjson;q=0')
+        res = self.client().get('/drinks', headers=ndjson)
+        json_res = self.client().get('/drinks', headers=refused)
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertIn('id', json.loads(res.data.splitlines()[0]))
+        self.assertEqual(json_res.mimetype, 'application/json')
+        self.assertTrue(json.loads(json_res.data)['success'])
+
+    def test_400_get_desserts_invalid_limit(self):
+        """Test 400 get desserts with invalid limit"""
+        res = self.client().get('/desserts?limit=abc',
+                                headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_400_search_drinks_negative_cursor(self):
+        """Test 400 search drinks with a negative cursor"""
+        res = self.client().get('/drinks?q=seed&cursor=-1',
+                                headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
     def test_update_drink(self):
         """Test update drink"""
         res = self.client().patch('/drinks/5', json=self.update_drink,
@@ -141,6 +422,200 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    def test_update_drinks_bulk(self):
+        """Test bulk update drinks"""
+        res = self.client().patch('/drinks/bulk',
+                                  json={'items': [{'id': 500,
+                                                   'title': 'missing'}]},
+                                  headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['missing'], [500])
+
+    def test_update_drinks_bulk_renames(self):
+        """Test bulk update drinks renames every row"""
+        _, drinks = self.create_items('drinks', 2)
+        prefix = uuid.uuid4().hex
+        renamed = [{'id': drink['id'], 'title': '%s %d' % (prefix, i)}
+                   for i, drink in enumerate(drinks)]
+        res = self.client().patch('/drinks/bulk', json={'items': renamed},
+                                  headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'], renamed)
+        self.assertEqual(data['missing'], [])
+        self.assertEqual(self.search('drinks', prefix), renamed)
+
+    def test_422_update_drinks_bulk_title_taken(self):
+        """Test 422 bulk update drinks onto a taken title"""
+        prefix, drinks = self.create_items('drinks', 2)
+        with self.assertLogs(self.app.logger, 'ERROR') as logs:
+            res = self.client().patch('/drinks/bulk', json={'items': [
+                {'id': drinks[0]['id'], 'title': drinks[1]['title']}]},
+                headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertIn('Unprocessable Entity', data['message'])
+        self.assertEqual(self.search('drinks', prefix), drinks)
+        self.assertIn('bulk update of drinks failed', logs.output[0])
+
+    def test_delete_desserts_bulk(self):
+        """Test bulk delete desserts"""
+        res = self.client().delete('/desserts/bulk', json={'ids': [500]},
+                                   headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['missing'], [500])
+
+    def test_delete_desserts_bulk_removes_rows(self):
+        """Test bulk delete desserts removes every row"""
+        prefix, desserts = self.create_items('desserts', 3)
+        ids = [dessert['id'] for dessert in desserts[:2]]
+        res = self.client().delete('/desserts/bulk', json={'ids': ids},
+                                   headers=self.manager_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['delete']), ids)
+        self.assertEqual(data['missing'], [])
+        self.assertEqual(self.search('desserts', prefix), desserts[2:])
+
+    def test_get_menu_events(self):
+        """Test subscribe to menu events"""
+        self.app.extensions['event_subscribers'] = AdmissionControl(1)
+        res = self.client().get('/menu/events', headers=self.barista_token,
+                                buffered=False)
+        first = next(iter(res.response))
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertEqual(first, b'retry: 3000\n\n')
+
+    def test_head_menu_events_unsubscribes(self):
+        """Test menu events unsubscribe when the body is never read"""
+        self.app.extensions['event_subscribers'] = AdmissionControl(1)
+        subscribers = set(broker.subscribers)
+        res = self.client().head('/menu/events', headers=self.barista_token,
+                                 buffered=False)
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(broker.subscribers, subscribers)
+        self.assertEqual(self.app.extensions['event_subscribers'].in_flight,
+                         0)
+
+    def test_503_get_menu_events_subscriber_cap(self):
+        """Test 503 subscribe to menu events past the subscriber cap"""
+        self.app.extensions['event_subscribers'] = AdmissionControl(
+            1, retry_after=30)
+        first = self.client().get('/menu/events', headers=self.barista_token,
+                                  buffered=False)
+        res = self.client().get('/menu/events', headers=self.barista_token)
+        first.close()
+        data = json.loads(res.data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertEqual(res.headers['Retry-After'], '30')
+
+    def test_503_get_menu_events_disabled(self):
+        """Test 503 subscribe to menu events with no subscriber slots"""
+        with mock.patch('resources.MAX_EVENT_SUBSCRIBERS', 0):
+            app = create_app()
+        res = app.test_client().get('/menu/events',
+                                    headers=self.barista_token)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res.headers)
+
+    def test_get_metrics(self):
+        """Test get metrics"""
+        self.client().get('/drinks', headers=self.barista_token)
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'http_request_duration_seconds_count', res.data)
+
+    def test_get_drinks_sql_profile(self):
+        """Test get drinks with sql profiling in debug mode"""
+        app = create_app()
+        app.debug = True
+        init_profiling(app, QueryProfiler())
+        res = app.test_client().get('/drinks', headers=self.barista_token)
+        report = json.loads(app.test_client().get('/debug/sql').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('queries=', res.headers['X-SQL-Profile'])
+        self.assertEqual(report['/drinks']['requests'], 1)
+
+    def test_get_drinks_sql_profile_not_exposed(self):
+        """Test get drinks with sql profiling outside debug mode"""
+        app = create_app()
+        profiler = init_profiling(app, QueryProfiler())
+        res = app.test_client().get('/drinks', headers=self.barista_token)
+        debug = app.test_client().get('/debug/sql')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-SQL-Profile', res.headers)
+        self.assertEqual(debug.status_code, 404)
+        self.assertEqual(profiler.report()['/drinks']['requests'], 1)
+
+    def test_get_drinks_replica_down(self):
+        """Test get drinks when a read replica is unreachable"""
+        replica_urls = 'sqlite:////nonexistent/replica.db,' + database_path
+        with mock.patch.dict(os.environ,
+                             {'DATABASE_REPLICA_URLS': replica_urls}):
+            app = create_app()
+        res = app.test_client().get('/drinks', headers=self.barista_token)
+        data = json.loads(res.data)
+        down, up = app.extensions['replicas'].engines
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertFalse(app.extensions['replicas'].is_up(down))
+        self.assertTrue(app.extensions['replicas'].is_up(up))
+
+    def test_get_drinks_gzip(self):
+        """Test get drinks with gzip compression"""
+        self.app.extensions['compressor'].min_size = 0
+        res = self.client().get('/drinks', headers=dict(
+            self.barista_token, **{'Accept-Encoding': 'gzip'}))
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertTrue(data['success'])
+
+    def test_429_get_drinks(self):
+        """Test 429 get drinks over the rate limit"""
+        self.app.extensions['rate_limiter'] = RateLimiter(rate=0.5, burst=1)
+        self.client().get('/drinks', headers=self.barista_token)
+        res = self.client().get('/drinks', headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertFalse(data['success'])
+
+    def test_503_get_drinks(self):
+        """Test 503 get drinks over the concurrency limit"""
+        self.app.extensions['admission'].limit = 0
+        res = self.client().get('/drinks', headers=self.barista_token)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res.headers)
+        self.assertFalse(data['success'])
+
     def test_401_get_drinks(self):
         """Test 401 get drinks"""
         res = self.client().get('/drinks')
@@ -157,6 +632,14 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         self.assertFalse(data['success'])
 
+    def test_401_get_menu_events(self):
+        """Test 401 subscribe to menu events"""
+        res = self.client().get('/menu/events')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
     def test_401_post_drink(self):
         """Test 401 post drink"""
         res = self.client().post('/drinks', json=self.new_drink)
@@ -0,0 +1,308 @@
+import json
+import os
+import unittest
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
+
+from starlette.testclient import TestClient
+from werkzeug.http import http_date
+
+from app import create_app
+import asgi
+from asgi import app as asgi_app
+from models import create_tables
+from ratelimit import RateLimiter
+
+
+manager_token = os.environ['MANAGER_TOKEN']
+barista_token = os.environ['BARISTA_TOKEN']
+
+
+class AsgiTestCase(unittest.TestCase):
+    """This class represents the async serving mode test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create the schema once for the whole test case"""
+        app = create_app()
+        with app.app_context():
+            create_tables()
+
+    def setUp(self):
+        """Start the ASGI app and define test variables"""
+        self.client = TestClient(asgi_app)
+        self.client.__enter__()
+
+        self.manager_token = {
+            "Authorization": "bearer {}".format(manager_token)}
+
+        self.barista_token = {
+            "Authorization": "bearer {}".format(barista_token)}
+
+    def tearDown(self):
+        """Stop the ASGI app"""
+        self.client.__exit__(None, None, None)
+
+    def create_drink(self):
+        title = 'drink ' + uuid.uuid4().hex
+        res = self.client.post('/drinks', json={'title': title},
+                               headers=self.manager_token)
+        return res.json()['drinks'][0]
+
+    def drink_titles(self):
+        # The changes feed lists every row, where /drinks stops at one page.
+        res = self.client.get('/drinks/changes?since=0',
+                              headers=self.barista_token)
+        return {drink['id']: drink['title'] for drink in res.json()['drinks']}
+
+    def test_upsert_drink(self):
+        """Test upsert drink bumps the version only when it creates"""
+        drink = {'title': 'drink ' + uuid.uuid4().hex}
+        res = self.client.post('/drinks?upsert=1', json=drink,
+                               headers=self.manager_token)
+        version = self.client.get('/drinks/changes',
+                                  headers=self.barista_token).json()['version']
+        again = self.client.post('/drinks?upsert=1', json=drink,
+                                 headers=self.manager_token)
+        changes = self.client.get('/drinks/changes',
+                                  headers=self.barista_token)
+
+        self.assertTrue(res.json()['created'])
+        self.assertFalse(again.json()['created'])
+        self.assertEqual(again.json()['drinks'], res.json()['drinks'])
+        self.assertEqual(changes.json()['version'], version)
+
+    def test_get_drinks(self):
+        """Test get drinks"""
+        res = self.client.get('/drinks', headers=self.barista_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn('ETag', res.headers)
+
+    def test_get_drinks_ndjson(self):
+        """Test get drinks as NDJSON only when it is preferred"""
+        ndjson = dict(self.barista_token, Accept='application/x-ndjson')
+        refused = dict(self.barista_token, Accept='application/json, '
+                       'application/x-ndjson;q=0')
+        res = self.client.get('/drinks', headers=ndjson)
+        json_res = self.client.get('/drinks', headers=refused)
+
+        self.assertTrue(
+            res.headers['content-type'].startswith('application/x-ndjson'))
+        self.assertIn('id', json.loads(res.text.splitlines()[0]))
+        self.assertTrue(
+            json_res.headers['content-type'].startswith('application/json'))
+        self.assertTrue(json_res.json()['success'])
+
+    def test_304_get_drinks_not_modified(self):
+        """Test get drinks with a matching ETag"""
+        res = self.client.get('/drinks', headers=self.barista_token)
+        headers = dict(self.barista_token,
+                       **{'If-None-Match': res.headers['ETag']})
+        res = self.client.get('/drinks', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, b'')
+
+    def test_search_drinks(self):
+        """Test search drinks after a write"""
+        drink = self.create_drink()
+        res = self.client.get('/drinks?q=' + drink['title'][6:],
+                              headers=self.barista_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'], [drink])
+
+    def test_400_search_drinks_negative_cursor(self):
+        """Test 400 search drinks with a negative cursor"""
+        res = self.client.get('/drinks?q=seed&cursor=-1',
+                              headers=self.barista_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_get_drinks_modified_within_the_second(self):
+        """Test get drinks If-Modified-Since after a write that second"""
+        start = (datetime.utcnow() - timedelta(seconds=5)).replace(
+            microsecond=100000)
+        clock = mock.Mock()
+        clock.utcnow.return_value = start
+        with mock.patch('asgi.datetime', clock), \
+                mock.patch('resources.datetime', clock):
+            self.create_drink()
+            first = self.client.get('/drinks', headers=self.barista_token)
+            self.create_drink()
+            headers = dict(self.barista_token,
+                           **{'If-Modified-Since': http_date(start)})
+            second = self.client.get('/drinks', headers=headers)
+            clock.utcnow.return_value = start + timedelta(seconds=1)
+            settled = self.client.get('/drinks', headers=self.barista_token)
+
+        self.assertNotIn('Last-Modified', first.headers)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(settled.headers['Last-Modified'], http_date(start))
+
+    def test_post_new_drink(self):
+        """Test post new drink"""
+        drink = self.create_drink()
+
+        self.assertEqual(self.drink_titles()[drink['id']], drink['title'])
+
+    def test_post_new_drink_idempotent(self):
+        """Test post new drink retried with an idempotency key"""
+        headers = dict(self.manager_token,
+                       **{'Idempotency-Key': uuid.uuid4().hex})
+        drink = {'title': 'drink ' + uuid.uuid4().hex}
+        res = self.client.post('/drinks', json=drink, headers=headers)
+        retry = self.client.post('/drinks', json=drink, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), res.json())
+
+    def test_update_drink(self):
+        """Test update drink"""
+        drink = self.create_drink()
+        title = 'drink ' + uuid.uuid4().hex
+        res = self.client.patch('/drinks/%d' % drink['id'],
+                                json={'title': title},
+                                headers=self.manager_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'][0]['title'], title)
+        self.assertEqual(self.drink_titles()[drink['id']], title)
+
+    def test_delete_drink(self):
+        """Test delete drink"""
+        drink = self.create_drink()
+        res = self.client.delete('/drinks/%d' % drink['id'],
+                                 headers=self.manager_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['delete'], str(drink['id']))
+        self.assertNotIn(drink['id'], self.drink_titles())
+
+    def test_404_update_drink(self):
+        """Test 404 update a drink that does not exist"""
+        res = self.client.patch('/drinks/100000', json={'title': 'x'},
+                                headers=self.manager_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_post_drinks_bulk(self):
+        """Test bulk post drinks"""
+        title = 'drink ' + uuid.uuid4().hex
+        res = self.client.post('/drinks/bulk',
+                               json={'titles': [title, title]},
+                               headers=self.manager_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][1]['status'], 'duplicate')
+        self.assertIn(title, self.drink_titles().values())
+
+    def test_post_drinks_bulk_lost_race(self):
+        """Test bulk post drinks retries a title claimed mid-request"""
+        drink = self.create_drink()
+        fetch_all = asgi.database.fetch_all
+        calls = []
+
+        async def stale_first_lookup(query):
+            # The first lookup misses the row, as if it were inserted by a
+            # concurrent request just after it.
+            calls.append(query)
+            return [] if len(calls) == 1 else await fetch_all(query)
+
+        with mock.patch.object(asgi.database, 'fetch_all',
+                               stale_first_lookup):
+            res = self.client.post('/drinks/bulk',
+                                   json={'titles': [drink['title']]},
+                                   headers=self.manager_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [{
+            'id': drink['id'], 'title': drink['title'],
+            'status': 'duplicate'}])
+
+    def test_update_drinks_bulk(self):
+        """Test bulk update drinks"""
+        first, second = self.create_drink(), self.create_drink()
+        renames = {first['id']: 'drink ' + uuid.uuid4().hex,
+                   second['id']: 'drink ' + uuid.uuid4().hex}
+        res = self.client.patch('/drinks/bulk', json={'items': [
+            {'id': id, 'title': title} for id, title in renames.items()]},
+            headers=self.manager_token)
+        titles = self.drink_titles()
+
+        self.assertEqual(res.status_code, 200)
+        for id, title in renames.items():
+            self.assertEqual(titles[id], title)
+
+    def test_delete_drinks_bulk(self):
+        """Test bulk delete drinks"""
+        ids = [self.create_drink()['id'], self.create_drink()['id']]
+        res = self.client.delete('/drinks/bulk', json={'ids': ids},
+                                 headers=self.manager_token)
+        titles = self.drink_titles()
+
+        self.assertEqual(res.status_code, 200)
+        for id in ids:
+            self.assertNotIn(id, titles)
+
+    def test_429_get_drinks(self):
+        """Test 429 get drinks over the rate limit"""
+        asgi_app.state.rate_limiter = RateLimiter(rate=0.5, burst=1)
+        self.addCleanup(setattr, asgi_app.state, 'rate_limiter', None)
+        self.client.get('/drinks', headers=self.barista_token)
+        res = self.client.get('/drinks', headers=self.barista_token)
+        other_route = self.client.get('/desserts', headers=self.barista_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertFalse(data['success'])
+        self.assertEqual(other_route.status_code, 200)
+
+    def test_503_get_drinks(self):
+        """Test 503 get drinks over the concurrency limit"""
+        admission = asgi_app.state.admission
+        self.addCleanup(setattr, admission, 'limit', admission.limit)
+        admission.limit = 0
+        res = self.client.get('/drinks', headers=self.barista_token)
+        data = res.json()
+
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res.headers)
+        self.assertFalse(data['success'])
+        self.assertEqual(admission.in_flight, 0)
+
+    def test_401_get_drinks(self):
+        """Test 401 get drinks"""
+        res = self.client.get('/drinks')
+        data = res.json()
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
+    def test_401_post_drink(self):
+        """Test 401 post drink"""
+        res = self.client.post('/drinks', json={'title': 'x'})
+        data = res.json()
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
+
+if __name__ == "__main__":
+    unittest.main()
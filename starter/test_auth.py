@@ -0,0 +1,161 @@
+import asyncio
+import os
+import threading
+import unittest
+from unittest import mock
+
+from auth import JWKSKeyStore, token_cache, token_digest, verify_token
+
+
+manager_token = os.environ['MANAGER_TOKEN']
+
+
+def signing_key(kid):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'modulus',
+            'e': 'AQAB'}
+
+
+def jwks(*kids):
+    return {'keys': [signing_key(kid) for kid in kids]}
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        """Define a key store with a controllable clock"""
+        self.store = JWKSKeyStore('https://example.com/jwks.json', ttl=600,
+                                  min_refresh_interval=30)
+        self.now = 1000.0
+        clock = mock.patch('auth.time.monotonic', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_load_keys_skips_unusable_keys(self):
+        """Test load keys skips keys that cannot verify signatures"""
+        without_use = signing_key('no-use')
+        del without_use['use']
+        keys = JWKSKeyStore.load_keys({'keys': [
+            signing_key('rsa'),
+            without_use,
+            dict(signing_key('enc'), use='enc'),
+            {'kty': 'EC', 'kid': 'ec', 'crv': 'P-256', 'x': 'x', 'y': 'y'},
+            {'kty': 'RSA', 'kid': 'no-modulus', 'use': 'sig', 'e': 'AQAB'},
+            {'kty': 'RSA', 'use': 'sig', 'n': 'modulus', 'e': 'AQAB'}
+        ]})
+
+        self.assertEqual(sorted(keys), ['no-use', 'rsa'])
+        self.assertEqual(keys['rsa'], signing_key('rsa'))
+        self.assertNotIn('use', keys['no-use'])
+
+    def test_get_key_refetches_after_ttl(self):
+        """Test get key refetches once the keys are older than the ttl"""
+        with mock.patch.object(self.store, 'fetch',
+                               return_value=jwks('a')) as fetch:
+            self.store.get_key('a')
+            self.now += 599
+            self.store.get_key('a')
+            self.assertEqual(fetch.call_count, 1)
+
+            self.now += 1
+            self.assertEqual(self.store.get_key('a'), signing_key('a'))
+            self.assertEqual(fetch.call_count, 2)
+
+    def test_get_key_unknown_kid_forces_refetch(self):
+        """Test get key refetches early for an unknown kid, rate limited"""
+        with mock.patch.object(self.store, 'fetch', side_effect=[
+                jwks('a'), jwks('a'), jwks('a', 'b')]) as fetch:
+            self.store.get_key('a')
+            self.now += 30
+            self.assertIsNone(self.store.get_key('b'))
+            self.assertEqual(fetch.call_count, 2)
+
+            self.now += 29
+            self.assertIsNone(self.store.get_key('b'))
+            self.assertEqual(fetch.call_count, 2)
+
+            self.now += 1
+            self.assertEqual(self.store.get_key('b'), signing_key('b'))
+            self.assertEqual(fetch.call_count, 3)
+
+    def test_get_key_keeps_keys_when_fetch_fails(self):
+        """Test get key serves the last keys when a refetch fails"""
+        with mock.patch.object(self.store, 'fetch', side_effect=[
+                jwks('a'), OSError('unreachable')]):
+            self.store.get_key('a')
+            self.now += 600
+
+            self.assertEqual(self.store.get_key('a'), signing_key('a'))
+
+    def test_get_key_single_flight(self):
+        """Test concurrent get key calls share one fetch"""
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            fetching.set()
+            release.wait(5)
+            return jwks('a')
+
+        results = []
+        with mock.patch.object(self.store, 'fetch',
+                               side_effect=slow_fetch) as fetch:
+            threads = [threading.Thread(
+                target=lambda: results.append(self.store.get_key('a')))
+                for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            fetching.wait(5)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(results, [signing_key('a')] * 8)
+
+    def test_get_key_async_single_flight(self):
+        """Test concurrent async get key calls share one fetch"""
+        calls = []
+
+        async def slow_fetch():
+            calls.append(None)
+            # Yields to the other callers; the event loop's clock is the
+            # patched one, so a timed sleep would never end.
+            await asyncio.sleep(0)
+            return jwks('a')
+
+        async def get_keys():
+            return await asyncio.gather(
+                *[self.store.get_key_async('a') for _ in range(8)])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch.object(self.store, 'fetch_async', slow_fetch):
+            results = loop.run_until_complete(get_keys())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [signing_key('a')] * 8)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        """Start from an empty token cache"""
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+
+    def test_verified_token_expires_at_exp(self):
+        """Test a verified token is cached until its exp claim"""
+        payload, _ = verify_token(manager_token)
+        digest = token_digest(manager_token)
+
+        self.assertIsNotNone(token_cache.get(digest))
+        with mock.patch.object(token_cache, '_clock',
+                               lambda: payload['exp']):
+            self.assertIsNone(token_cache.get(digest))
+        self.assertIsNone(token_cache.get(digest))
+
+
+if __name__ == "__main__":
+    unittest.main()